@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+'''
+Scrapeports extensions
+
+See: https://doc.scrapy.org/en/latest/topics/extensions.html
+'''
+import json
+import logging
+import os
+import time
+
+from scrapy import signals
+from scrapy.extensions.httpcache import FilesystemCacheStorage
+from scrapy.utils.misc import load_object
+from scrapy.utils.project import data_path
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def _disk_usage(path, name, directory):
+    '''
+    Bytes taken by the cache of spider name in path: its directory, as
+    the filesystem storage has, or else files named after it.
+    '''
+
+    if directory:
+        return sum(os.path.getsize(os.path.join(root, x))
+                   for root, _, files in os.walk(os.path.join(path, name))
+                   for x in files)
+
+    if not os.path.isdir(path):
+        return 0
+
+    return sum(x.stat().st_size
+               for x in os.scandir(path)
+               if x.is_file() and x.name.startswith(name + '.'))
+
+
+class CrawlReport:
+    '''
+    Sum a crawl up once the engine stops: pages per second, HTTP cache hit
+    ratio and the size of the cache on disk, its storage closed by then,
+    in a log line; with CRAWL_REPORT set, written there as JSON too.
+
+    Cache hits are the pages served from the cache, fresh or revalidated
+    with a 304, out of all the cache lookups.
+    '''
+
+    def __init__(self, settings, stats):
+        self.stats = stats
+        self.path = settings.get('CRAWL_REPORT')
+        self.cachedir = None
+        if settings.getbool('HTTPCACHE_ENABLED'):
+            self.cachedir = data_path(settings['HTTPCACHE_DIR'])
+        self.directory = issubclass(load_object(settings['HTTPCACHE_STORAGE']),
+                                    FilesystemCacheStorage)
+        self.spider = self.started = None
+
+    @classmethod
+    def from_crawler(cls, crawler):  # pylint: disable=missing-docstring
+        extension = cls(crawler.settings, crawler.stats)
+        crawler.signals.connect(extension.spider_opened,
+                                signal=signals.spider_opened)
+        crawler.signals.connect(extension.engine_stopped,
+                                signal=signals.engine_stopped)
+        return extension
+
+    def spider_opened(self, spider):  # pylint: disable=missing-docstring
+        self.spider = spider
+        self.started = time.monotonic()
+
+    def results(self):
+        '''
+        The report of the crawl so far.
+        '''
+
+        wall = time.monotonic() - self.started
+        value = self.stats.get_value
+
+        pages = value('response_received_count', 0)
+        hits = value('httpcache/hit', 0) + value('httpcache/revalidate', 0)
+        lookups = hits + value('httpcache/invalidate', 0) \
+            + value('httpcache/miss', 0)
+
+        return {
+            'spider': self.spider.name,
+            'reason': value('finish_reason'),
+            'wall': wall,
+            'pages': pages,
+            'pages_per_second': pages / wall if wall else 0,
+            'cache_lookups': lookups,
+            'cache_hit_ratio': hits / lookups if lookups else None,
+            'cache_bytes': _disk_usage(self.cachedir, self.spider.name,
+                                       self.directory)
+                           if self.cachedir else None,
+        }
+
+    def engine_stopped(self):  # pylint: disable=missing-docstring
+        if self.spider is None:
+            return
+
+        results = self.results()
+
+        logger.info('%(pages)d pages in %(wall).1fs, %(pages_per_second).1f '
+                    'pages/s, cache hit ratio %(ratio)s, cache size %(size)s '
+                    'bytes',
+                    dict(results,
+                         ratio=('n/a' if results['cache_hit_ratio'] is None
+                                else f'{results["cache_hit_ratio"]:.2f}'),
+                         size=('n/a' if results['cache_bytes'] is None
+                               else results['cache_bytes'])),
+                    extra={'spider': self.spider})
+
+        if self.path:
+            with open(self.path, 'w') as output:
+                json.dump(results, output, indent=2)
+                output.write('\n')
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+'''
+Scrapeports HTTP cache storage
+
+See: https://doc.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-storage-backends
+'''
+import logging
+import os
+import pickle
+import sqlite3
+import time
+import zlib
+
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+
+try:
+    from scrapy.utils.request import fingerprint
+except ImportError:  # scrapy < 2.7
+    from scrapy.utils.request import request_fingerprint as fingerprint
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class SqliteCacheStorage:
+    '''
+    Cached responses in one sqlite database per spider under HTTPCACHE_DIR,
+    <spider>.sqlite, rather than a directory of small files per page:
+    pickled, zlib compressed at HTTPCACHE_COMPRESSION_LEVEL, keyed by
+    request fingerprint.
+
+    Pages take a fraction of their size and a cached crawl reads a single
+    file.
+    '''
+
+    def __init__(self, settings):
+        self.cachedir = data_path(settings['HTTPCACHE_DIR'], createdir=True)
+        self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        self.level = settings.getint('HTTPCACHE_COMPRESSION_LEVEL', 6)
+        self.connection = None
+        self.fingerprint = None
+
+    def open_spider(self, spider):  # pylint: disable=missing-docstring
+        path = os.path.join(self.cachedir, f'{spider.name}.sqlite')
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS responses '
+                                '(fingerprint BLOB PRIMARY KEY, '
+                                'time REAL NOT NULL, '
+                                'data BLOB NOT NULL)')
+
+        logger.debug('Using sqlite cache storage in %(cachepath)s',
+                     {'cachepath': path}, extra={'spider': spider})
+
+        # REQUEST_FINGERPRINTER_CLASS, if this scrapy has it
+        fingerprinter = getattr(spider.crawler, 'request_fingerprinter', None)
+        self.fingerprint = fingerprinter.fingerprint if fingerprinter \
+            else fingerprint
+
+    def close_spider(self, spider):  # pylint: disable=missing-docstring,unused-argument
+        self.connection.close()
+
+    def retrieve_response(self, spider, request):  # pylint: disable=missing-docstring,unused-argument
+        row = self.connection.execute(
+            'SELECT time, data FROM responses WHERE fingerprint = ?',
+            (self.fingerprint(request),)).fetchone()
+        if row is None:
+            return None  # not cached
+
+        stored, data = row
+        if 0 < self.expiration_secs < time.time() - stored:
+            return None  # expired
+
+        data = pickle.loads(zlib.decompress(data))
+        headers = Headers(data['headers'])
+        respcls = responsetypes.from_args(headers=headers, url=data['url'],
+                                          body=data['body'])
+
+        request.meta['cache_timestamp'] = stored
+        return respcls(url=data['url'], headers=headers,
+                       status=data['status'], body=data['body'])
+
+    def store_response(self, spider, request, response):  # pylint: disable=missing-docstring,unused-argument
+        data = {'status': response.status,
+                'url': response.url,
+                'headers': dict(response.headers),
+                'body': response.body}
+        self.connection.execute(
+            'INSERT OR REPLACE INTO responses VALUES (?, ?, ?)',
+            (self.fingerprint(request), time.time(),
+             zlib.compress(pickle.dumps(data, protocol=4), self.level)))
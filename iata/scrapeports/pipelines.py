@@ -1,11 +1,242 @@
 # -*- coding: utf-8 -*-
+'''
+Scrapeports item pipelines
 
-# Define your item pipelines here
-#
-# Don't forget to add your pipeline to the ITEM_PIPELINES setting
-# See: https://doc.scrapy.org/en/latest/topics/item-pipeline.html
+See: https://doc.scrapy.org/en/latest/topics/item-pipeline.html
+'''
+import base64
+import io
+import json
+import logging
+from urllib.parse import quote
 
+from scrapy.exceptions import NotConfigured
+from twisted.internet import defer
+from twisted.web.client import (Agent, FileBodyProducer, HTTPConnectionPool,
+                                readBody)
+from twisted.web.http_headers import Headers
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+WHEN_EXISTING = ('overwrite', 'update', 'ignore')
+
+
+class CouchDBError(Exception):
+    '''
+    Unexpected CouchDB response.
+    '''
+
+
+def _diff(docs, existing, when_existing):
+    '''
+    Documents to write for a batch, given the existing ones by _id, and
+    how many are unchanged; the same policy as tools/ingest.py
+    --when-existing.
+    '''
+
+    batch = []
+    unchanged = 0
+    for doc in docs:
+
+        current = existing.get(doc['_id'])
+        if current is None:
+            batch.append(doc)
+            continue
+
+        if doc.items() <= current.items():
+            unchanged += 1
+            continue
+
+        if when_existing == 'overwrite':
+            batch.append(dict(doc, _rev=current['_rev']))
+        elif when_existing == 'update':
+            batch.append(dict(current, **doc))
+
+    return batch, unchanged
+
+
+class CouchDBPipeline:
+    '''
+    Stream items to a CouchDB database as they are crawled, keyed by
+    IATA code, in _bulk_docs batches of COUCHDB_BATCH_SIZE items or
+    whatever came within COUCHDB_BATCH_LINGER seconds.
+
+    Each batch fetches its existing documents at once, then
+    COUCHDB_WHEN_EXISTING tells what to do with changed ones: overwrite,
+    update or ignore them. Requests go through a pooled twisted Agent,
+    the reactor never blocks; with COUCHDB_CONCURRENCY batches in flight
+    process_item() waits, slowing the crawl down to the database pace.
+
+    Disabled unless COUCHDB_DATABASE is set.
+    '''
+
+    def __init__(self, settings, stats):
+        self.dbname = settings.get('COUCHDB_DATABASE')
+        self.dburl = '{}/{}'.format(settings.get('COUCHDB_URL').rstrip('/'),
+                                    quote(self.dbname, safe=''))
+        self.create_database = settings.getbool('COUCHDB_CREATE_DATABASE')
+        self.when_existing = settings.get('COUCHDB_WHEN_EXISTING')
+        self.batch_size = settings.getint('COUCHDB_BATCH_SIZE')
+        self.linger = settings.getfloat('COUCHDB_BATCH_LINGER')
+        self.concurrency = settings.getint('COUCHDB_CONCURRENCY')
+        self.stats = stats
+
+        self.headers = {b'Accept': [b'application/json'],
+                        b'Content-Type': [b'application/json']}
+        if settings.get('COUCHDB_USER'):
+            credentials = base64.b64encode('{}:{}'.format(
+                settings.get('COUCHDB_USER'),
+                settings.get('COUCHDB_PASS') or '').encode())
+            self.headers[b'Authorization'] = [b'Basic ' + credentials]
+
+        self.buffer = {}
+        self.pending = set()
+        self.slots = defer.DeferredSemaphore(self.concurrency)
+        self.reactor = self.pool = self.agent = self.timer = None
+
+    @classmethod
+    def from_crawler(cls, crawler):  # pylint: disable=missing-docstring
+        settings = crawler.settings
+
+        if not settings.get('COUCHDB_DATABASE'):
+            raise NotConfigured('COUCHDB_DATABASE is not set')
+
+        if settings.get('COUCHDB_WHEN_EXISTING') not in WHEN_EXISTING:
+            raise NotConfigured('COUCHDB_WHEN_EXISTING must be one of '
+                                + ', '.join(WHEN_EXISTING))
+
+        return cls(settings, crawler.stats)
+
+    @defer.inlineCallbacks
+    def _request(self, method, url, body=None):
+        '''
+        Deferred (status code, decoded JSON body) of a request.
+        '''
+
+        producer = None
+        if body is not None:
+            producer = FileBodyProducer(
+                io.BytesIO(json.dumps(body).encode()))
+
+        response = yield self.agent.request(method, url.encode(),
+                                            Headers(self.headers), producer)
+        data = yield readBody(response)
+
+        return response.code, json.loads(data) if data else None
+
+    # Deferreds rather than coroutines, and spider optional: older scrapy
+    # passes it along and does not await open_spider() and close_spider()
+    @defer.inlineCallbacks
+    def open_spider(self, spider=None):  # pylint: disable=missing-docstring,unused-argument
+        # the crawler one, installed by now
+        from twisted.internet import reactor  # pylint: disable=import-outside-toplevel
+
+        self.reactor = reactor
+        self.pool = HTTPConnectionPool(reactor)
+        self.pool.maxPersistentPerHost = self.concurrency
+        self.agent = Agent(reactor, pool=self.pool)
+
+        if self.create_database:
+            code, _ = yield self._request(b'PUT', self.dburl)
+            if code not in (201, 202, 412):
+                raise CouchDBError(f'cannot create database {self.dbname}: '
+                                   f'HTTP {code}')
+        else:
+            code, _ = yield self._request(b'GET', self.dburl)
+            if code != 200:
+                raise CouchDBError(f'database {self.dbname} not found')
+
+    def _add(self, doc):
+        '''
+        Buffer doc, applying the existing policy to a buffered one with
+        the same _id.
+        '''
+
+        current = self.buffer.get(doc['_id'])
+        if current is None or self.when_existing == 'overwrite':
+            self.buffer[doc['_id']] = doc
+        elif self.when_existing == 'update':
+            self.buffer[doc['_id']] = dict(current, **doc)
+
+    @defer.inlineCallbacks
+    def process_item(self, item, spider=None):  # pylint: disable=missing-docstring,unused-argument
+        doc = dict(item)
+
+        if not doc.get('iata'):
+            logger.debug('skipping null IATA code: %s', doc)
+            self.stats.inc_value('couchdb/skipped')
+            return item
+
+        doc['_id'] = doc['iata']
+        self._add(doc)
+
+        if len(self.buffer) >= self.batch_size:
+            self._flush()
+            # hold the crawl while every slot is busy
+            yield self.slots.acquire()
+            self.slots.release()
+        elif self.timer is None:
+            self.timer = self.reactor.callLater(self.linger, self._flush)
 
-class ScrapeportsPipeline(object):
-    def process_item(self, item, spider):
         return item
+
+    def _flush(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+
+        if not self.buffer:
+            return
+
+        docs = list(self.buffer.values())
+        self.buffer = {}
+
+        deferred = self.slots.run(self._write, docs)
+        self.pending.add(deferred)
+        deferred.addErrback(self._failed, docs)
+        deferred.addBoth(lambda _: self.pending.discard(deferred))
+
+    @defer.inlineCallbacks
+    def _write(self, docs):
+        code, result = yield self._request(
+            b'POST', f'{self.dburl}/_all_docs?include_docs=true',
+            {'keys': [doc['_id'] for doc in docs]})
+        if code != 200:
+            raise CouchDBError(f'_all_docs: HTTP {code} {result}')
+
+        existing = {row['key']: row['doc']
+                    for row in result['rows']
+                    if row.get('doc')}
+        batch, unchanged = _diff(docs, existing, self.when_existing)
+
+        written = []
+        if batch:
+            code, written = yield self._request(
+                b'POST', f'{self.dburl}/_bulk_docs', {'docs': batch})
+            # 202: written, short of the cluster write quorum
+            if code not in (201, 202):
+                raise CouchDBError(f'_bulk_docs: HTTP {code} {written}')
+
+        errors = [row for row in written if 'error' in row]
+        for row in errors:
+            logger.warning('failed %s: %s %s',
+                           row['id'], row['error'], row.get('reason'))
+
+        self.stats.inc_value('couchdb/batches')
+        self.stats.inc_value('couchdb/written', len(batch) - len(errors))
+        self.stats.inc_value('couchdb/unchanged', unchanged)
+        # changed, but left as they are with COUCHDB_WHEN_EXISTING ignore
+        self.stats.inc_value('couchdb/ignored',
+                             len(docs) - len(batch) - unchanged)
+        self.stats.inc_value('couchdb/failed', len(errors))
+
+    def _failed(self, failure, docs):
+        logger.error('batch of %d items not written: %s',
+                     len(docs), failure.getErrorMessage())
+        self.stats.inc_value('couchdb/failed', len(docs))
+
+    @defer.inlineCallbacks
+    def close_spider(self, spider=None):  # pylint: disable=missing-docstring,unused-argument
+        self._flush()
+        yield defer.DeferredList(list(self.pending))
+        yield self.pool.closeCachedConnections()
@@ -59,15 +59,33 @@ ROBOTSTXT_OBEY = True
 
 # Enable or disable extensions
 # See https://doc.scrapy.org/en/latest/topics/extensions.html
-# EXTENSIONS = {
+EXTENSIONS = {
 #    'scrapy.extensions.telnet.TelnetConsole': None,
-#}
+    'scrapeports.extensions.CrawlReport': 500,
+}
+
+# Pages/s, cache hit ratio and size summed up when the crawl is over, also
+# written here as JSON if set
+CRAWL_REPORT = None
 
 # Configure item pipelines
 # See https://doc.scrapy.org/en/latest/topics/item-pipeline.html
-# ITEM_PIPELINES = {
-#    'scrapeports.pipelines.ScrapeportsPipeline': 300,
-#}
+ITEM_PIPELINES = {
+    'scrapeports.pipelines.CouchDBPipeline': 300,
+}
+
+# Write airports to CouchDB while crawling, keyed by IATA code. Off unless
+# a database is given, e.g. scrapy crawl iata -s COUCHDB_DATABASE=airports
+COUCHDB_URL = 'http://localhost:5984'
+COUCHDB_USER = None
+COUCHDB_PASS = None
+COUCHDB_DATABASE = None
+COUCHDB_CREATE_DATABASE = True
+# overwrite, update or ignore changed existing documents
+COUCHDB_WHEN_EXISTING = 'ignore'
+COUCHDB_BATCH_SIZE = 500
+COUCHDB_BATCH_LINGER = 1.0
+COUCHDB_CONCURRENCY = 2
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://doc.scrapy.org/en/latest/topics/autothrottle.html
@@ -90,5 +108,11 @@ HTTPCACHE_ENABLED = True
 #HTTPCACHE_DIR = 'httpcache'
 #HTTPCACHE_IGNORE_HTTP_CODES = []
 #HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
+# Revalidate cached pages with conditional requests (ETag, Last-Modified)
+# as they expire, wikipedia ones right away: unchanged pages come back
+# with a 304 and no body, see the iata spider incremental argument
+HTTPCACHE_POLICY = 'scrapy.extensions.httpcache.RFC2616Policy'
 
 HTTPCACHE_DIR = os.path.expanduser('~/.cache/scrapy/httpcache')
+# zlib level of the scrapeports.httpcache.SqliteCacheStorage responses
+HTTPCACHE_COMPRESSION_LEVEL = 6
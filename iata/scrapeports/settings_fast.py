@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=wildcard-import,unused-wildcard-import
+
+# Scrapy settings for the "fast" scrapeports crawl profile, select it with
+#
+#     SCRAPY_PROJECT=fast scrapy crawl iata
+#
+# On top of the default ones: a compressed single file HTTP cache and more
+# requests in parallel, AutoThrottle keeping wikipedia response times in
+# check. To replay the cache without touching the network at all, add
+#
+#     -s HTTPCACHE_POLICY=scrapy.extensions.httpcache.DummyPolicy
+
+from scrapeports.settings import *
+
+CONCURRENT_REQUESTS = 32
+CONCURRENT_REQUESTS_PER_DOMAIN = 8
+
+AUTOTHROTTLE_ENABLED = True
+AUTOTHROTTLE_START_DELAY = 0.25
+AUTOTHROTTLE_MAX_DELAY = 10
+# Requests in flight to each server AutoThrottle aims at, up to
+# CONCURRENT_REQUESTS_PER_DOMAIN
+AUTOTHROTTLE_TARGET_CONCURRENCY = 4.0
+
+HTTPCACHE_STORAGE = 'scrapeports.httpcache.SqliteCacheStorage'
@@ -1,12 +1,83 @@
 # -*- coding: utf-8 -*-
+from urllib.parse import urlparse
+
 from scrapy.linkextractors import LinkExtractor
+from scrapy.selector import Selector
 from scrapy.spiders.crawl import CrawlSpider, Rule
 from scrapeports.items import AirportItem
 
+ROWS = '//table[contains(@class, "sortable")]//tr[td]'
+
+
+def _xpath_airport(record):
+    '''
+    Airport fields of a row selector, one XPath query each.
+    '''
+
+    _x = record.xpath
+    airport = {}
+    airport['iata'] = _x('.//td[1]/text()').extract_first()
+    airport['icao'] = _x('.//td[2]/text()').extract_first()
+    airport['name'] = ''.join(_x('.//td[3]//text()').extract())
+    airport['location'] = ''.join(_x('.//td[4]//text()').extract())
+    airport['time'] = _x('.//td[5]//text()').extract_first()
+    airport['dst'] = _x('.//td[6]//text()').extract_first()
+
+    return airport
+
+
+def _first_child_text(cell):
+    # td/text(): the text before the first child or else the first tail
+    if cell.text is not None:
+        return cell.text
+    for child in cell:
+        if child.tail is not None:
+            return child.tail
+    return None
+
+
+def _airport(row):
+    '''
+    Airport fields of a lxml row element, same as _xpath_airport() but in
+    a single pass over its cells. Rows with cells nested in other cells,
+    which the XPath queries would pick up too, are left to it.
+    '''
+
+    cells = row.findall('td')
+    if len(cells) != sum(1 for _ in row.iter('td')):
+        return _xpath_airport(Selector(root=row))
+
+    iata, icao, name, location, time, dst = cells[:6] \
+        + [None] * (6 - len(cells))
+
+    return {'iata': _first_child_text(iata) if iata is not None else None,
+            'icao': _first_child_text(icao) if icao is not None else None,
+            'name': ''.join(name.itertext()) if name is not None else '',
+            'location': ''.join(location.itertext())
+                        if location is not None else '',
+            'time': next(time.itertext(), None) if time is not None else None,
+            'dst': next(dst.itertext(), None) if dst is not None else None}
+
+
+def _clean(airport):
+    # getting rid of empty or '\n' strings
+    return {k: v.strip() if v and v.strip() else None
+            for k, v
+            in airport.items()}
+
 
 class IataSpider(CrawlSpider):
     '''
     Crawl wikipedia collecting airport data.
+
+    Arguments (scrapy crawl iata -a name=value):
+
+    incremental: when true, list pages the HTTP cache tells unchanged
+                 since the last crawl (still fresh, or revalidated with
+                 a 304) are not parsed, only airports of changed pages
+                 come out
+    start_url: crawl another site laid out the same, e.g.
+               tools/fakewiki.py
     '''
     name = 'iata'
     allowed_domains = ['wikipedia.org']
@@ -18,19 +89,22 @@ class IataSpider(CrawlSpider):
                              '//a[contains(@href, "/wiki/List_of_airports_by_IATA")]']),
         callback='get_airport'),)
 
-    def get_airport(self, response):  # pylint: disable=no-self-use, missing-docstring
-
-        for record in response.xpath('//table[contains(@class, "sortable")]//tr[td]'):
-            _x = record.xpath
-            airport = {}
-            airport['iata'] = _x('.//td[1]/text()').extract_first()
-            airport['icao'] = _x('.//td[2]/text()').extract_first()
-            airport['name'] = ''.join(_x('.//td[3]//text()').extract())
-            airport['location'] = ''.join(_x('.//td[4]//text()').extract())
-            airport['time'] = _x('.//td[5]//text()').extract_first()
-            airport['dst'] = _x('.//td[6]//text()').extract_first()
-
-            # getting rid of empty or '\n' strings
-            yield AirportItem(**{k: v.strip() if v and v.strip() else None
-                                 for k, v
-                                 in airport.items()})
+    def __init__(self, *args, incremental=False, start_url=None, **kwargs):
+        if start_url:
+            self.start_urls = [start_url]
+            self.allowed_domains = [urlparse(start_url).hostname]
+
+        super().__init__(*args, **kwargs)
+
+        self.incremental = str(incremental).lower() in ('1', 'true', 'yes')
+
+    def get_airport(self, response):  # pylint: disable=missing-docstring
+
+        if self.incremental:
+            if 'cached' in response.flags:
+                self.crawler.stats.inc_value('incremental/unchanged_pages')
+                return
+            self.crawler.stats.inc_value('incremental/changed_pages')
+
+        for row in response.selector.root.xpath(ROWS):
+            yield AirportItem(**_clean(_airport(row)))
@@ -0,0 +1,946 @@
+#!/usr/bin/env python
+'''
+Created on 18 oct 2026
+
+@author: Alessandro Ogier <alessandro.ogier@gmail.com>
+'''
+import asyncio
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import statistics
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import click
+import ijson
+import marisa_trie
+
+import build
+import fakecouch
+import fakewiki
+import iata_words
+import ingest
+
+ACCENTED = 'àáâäçèéêëìíîïñòóôöùúûüßæœ'
+MALFORMED_CODES = {'A1B', '1AB', "'BC", 'ab1', 'ÀBC'}
+
+
+def _synthetic_codes(count, seed):
+    rand = random.Random(seed)
+    codes = [''.join(x)
+             for x
+             in itertools.product(string.ascii_uppercase, repeat=3)]
+    return set(rand.sample(codes, count))
+
+
+def _synthetic_words(count, seed, iata_codes=(), ratio=0.01):
+    '''
+    Random uppercase words; about `ratio` of them made of IATA codes.
+    '''
+    rand = random.Random(seed)
+    iata_codes = sorted(iata_codes)
+    for _ in range(count):
+        if iata_codes and rand.random() < ratio:
+            yield ''.join(rand.choice(iata_codes)
+                          for _ in range(rand.randint(1, 5)))
+        else:
+            yield ''.join(rand.choice(string.ascii_uppercase)
+                          for _ in range(rand.randint(2, 16)))
+
+
+def _rss(fields=('VmRSS', 'RssAnon', 'RssFile')):
+    '''
+    Current process resident set, in kB: total, anonymous and file backed.
+    '''
+    with open('/proc/self/status') as status:
+        values = dict(line.split(':', 1) for line in status)
+    return tuple(int(values[x].split()[0]) for x in fields)
+
+
+def _load_probe(tries, mmap, conn):
+    start = time.perf_counter()
+    trie = iata_words.load(tries, mmap)
+    elapsed = time.perf_counter() - start
+    loaded = _rss()
+    sum(1 for _ in trie.iterkeys())
+    conn.send((elapsed, loaded, _rss()))
+
+
+def _synthetic_lines(size, seed, unicode_ratio=0.1,  # pylint: disable=too-many-arguments
+                     iata_codes=(), iata_ratio=0.01):
+    '''
+    About size bytes of wordlist-like text lines, unicode_ratio of them
+    with accented letters and about iata_ratio of them made of IATA codes.
+    '''
+    rand = random.Random(seed)
+    ascii_letters = string.ascii_lowercase * 4 + "-.'"
+    accented = string.ascii_lowercase * 4 + ACCENTED
+    iata_codes = sorted(x.lower() for x in iata_codes)
+    lines = []
+    total = 0
+    while total < size:
+        if iata_codes and rand.random() < iata_ratio:
+            line = ''.join(rand.choice(iata_codes)
+                           for _ in range(rand.randint(1, 5)))
+            lines.append(line)
+            total += len(line) + 1
+            continue
+        letters = accented if rand.random() < unicode_ratio else ascii_letters
+        line = ''.join(rand.choice(letters)
+                       for _ in range(rand.randint(2, 16)))
+        lines.append(line)
+        total += len(line) + 1
+    return '\n'.join(lines) + '\n'
+
+
+def _synthetic_airports(count, seed):
+    rand = random.Random(seed)
+    codes = sorted(_synthetic_codes(count, seed))
+    return [{'iata': code,
+             'icao': rand.choice(string.ascii_uppercase) + code,
+             'name': f'{code.title()} International Airport',
+             'location': ''.join(rand.choice(string.ascii_lowercase)
+                                 for _ in range(rand.randint(8, 30))),
+             'time': f'UTC{rand.randint(-12, 12):+d}:00',
+             'dst': rand.choice('EANU')}
+            for code in codes]
+
+
+def _ingest(url, dbname, path, *args):
+    with open(path) as data:
+        subprocess.run([sys.executable,
+                        os.path.join(os.path.dirname(__file__), 'ingest.py'),
+                        '--couchdb-user', 'admin', '--couchdb-pass', 'admin',
+                        '--couchdb-url', url, '--database', dbname,
+                        '--id-field', 'iata', *args],
+                       stdin=data, stdout=subprocess.DEVNULL, check=True)
+
+
+def _timeit(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def _probe(conn, func, *args):
+    # ru_maxrss would count the parent, carried over exec
+    conn.send((func(*args), _rss(('VmHWM',))[0]))
+
+
+def _isolated(func, *args):
+    '''
+    func(*args) result and peak RSS in kB, run in a fresh process.
+    '''
+
+    context = multiprocessing.get_context('spawn')
+    parent, child = context.Pipe()
+    process = context.Process(target=_probe, args=(child, func, *args))
+    process.start()
+    result = parent.recv()
+    process.join()
+    return result
+
+
+def _latencies(timings):
+    return {'min': min(timings),
+            'median': statistics.median(timings),
+            'max': max(timings)}
+
+
+def _trie_probe(tries, runs):
+    keys = list(marisa_trie.Trie().mmap(tries).iterkeys())
+    return [_timeit(marisa_trie.Trie, keys)[0] for _ in range(runs)], \
+        len(keys)
+
+
+def _find_probe(tries, iata_codes, min_size, max_size,  # pylint: disable=too-many-arguments
+                use_index, runs):
+    timings = []
+    for _ in range(runs):
+        elapsed, words = _timeit(lambda: sum(1 for _ in iata_words.find(
+            iata_codes, tries, min_size, max_size, use_index=use_index)))
+        timings.append(elapsed)
+    return timings, words
+
+
+def _report(path):
+    with open(path) as report:
+        return json.load(report)
+
+
+def _size_range(ctx, param, value):  # pylint: disable=unused-argument
+    sizes = []
+    for size in value:
+        try:
+            min_size, max_size = size.split(':')
+            sizes.append((int(min_size), float(max_size)))
+        except ValueError:
+            raise click.BadParameter(f'{size} is not a MIN:MAX range')
+    return sizes
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.group()
+def main():
+    '''
+    Benchmark tools hot paths.
+    '''
+
+
+@main.command('find')
+@click.option('--tries',
+              help='wordlist tries path; a synthetic one is built if missing',
+              metavar='<path>')
+@click.option('--iata-codes',
+              help='IATA codes file, one per line; synthetic if missing',
+              metavar='<path>')
+@click.option('--words',
+              help='synthetic trie size',
+              default=2000000, show_default=True, type=click.INT)
+@click.option('--codes',
+              help='synthetic IATA codes set size',
+              default=9000, show_default=True, type=click.INT)
+@click.option('--max-size',
+              help='maximum word size',
+              default=float('inf'), show_default=True, type=click.FLOAT)
+@click.option('--seed', default=0, show_default=True, type=click.INT)
+def bench_find(tries, iata_codes, words, codes, max_size, seed):  # pylint: disable=too-many-arguments
+    '''
+    Compare find() strategies.
+    '''
+
+    if iata_codes:
+        iata_codes = set(x.strip() for x in open(iata_codes).readlines())
+    else:
+        iata_codes = _synthetic_codes(codes, seed)
+
+    synthetic = not tries
+    if synthetic:
+        _, tries = tempfile.mkstemp(suffix='.marisa')
+        elapsed, trie = _timeit(marisa_trie.Trie,
+                                _synthetic_words(words, seed, iata_codes))
+        trie.save(tries)
+        print(f'built synthetic trie: {len(trie)} words '
+              f'in {elapsed:.2f}s -> {tries}')
+
+    try:
+        results = {}
+        for strategy in iata_words.STRATEGIES:
+            elapsed, results[strategy] = _timeit(
+                lambda s=strategy: set(iata_words.find(iata_codes, tries,
+                                                       max_size=max_size,
+                                                       strategy=s)))
+            print(f'{strategy}: {len(results[strategy])} words '
+                  f'in {elapsed:.3f}s')
+
+        if len(set(map(frozenset, results.values()))) != 1:
+            raise click.ClickException('strategies results differ!')
+
+        # codes out of A-Z, e.g. 'A1B', are no word's but must not alias one
+        results = {strategy: set(iata_words.find(MALFORMED_CODES, tries,
+                                                 max_size=max_size,
+                                                 strategy=strategy))
+                   for strategy in iata_words.STRATEGIES}
+        if len(set(map(frozenset, results.values()))) != 1:
+            raise click.ClickException('strategies results differ on '
+                                       'malformed codes!')
+    finally:
+        if synthetic:
+            os.remove(tries)
+
+
+@main.command('workers')
+@click.option('--tries',
+              help='wordlist tries path',
+              required=True, metavar='<path>')
+@click.option('--iata-codes',
+              help='IATA codes file, one per line',
+              required=True, metavar='<path>')
+@click.option('--workers', 'pools',
+              help='pool sizes to compare',
+              default=[1, 2, 4, 8], show_default=True,
+              multiple=True, type=click.INT)
+@click.option('--unordered', is_flag=True, default=False)
+def bench_workers(tries, iata_codes, pools, unordered):
+    '''
+    find() scaling across worker processes, no max size.
+    '''
+
+    iata_codes = set(x.strip() for x in open(iata_codes).readlines())
+    print(f'{os.cpu_count()} cpus')
+
+    for workers in pools:
+        elapsed, words = _timeit(
+            lambda w=workers: sum(1 for _ in iata_words.find(
+                iata_codes, tries, use_index=False,
+                workers=w, ordered=not unordered)))
+        print(f'{workers} workers: {words} words in {elapsed:.3f}s')
+
+
+@main.command('normalize')
+@click.option('--size',
+              help='synthetic wordlist size, in MB',
+              default=20, show_default=True, type=click.INT)
+@click.option('--unicode-ratio',
+              help='ratio of lines with accented letters',
+              default=0.1, show_default=True, type=click.FLOAT)
+@click.option('--seed', default=0, show_default=True, type=click.INT)
+def bench_normalize(size, unicode_ratio, seed):
+    '''
+    Single core build normalization throughput, per line vs per block.
+    '''
+
+    text = _synthetic_lines(size * 2 ** 20, seed, unicode_ratio)
+    data = text.encode('utf-8')
+
+    def per_line():
+        return b''.join(ret + b'\n'
+                        for ret in map(build._normalize_line,  # pylint: disable=protected-access
+                                       text.splitlines())
+                        if ret is not None)
+
+    def per_block():
+        return b''.join(build._normalize_block(block)[0]  # pylint: disable=protected-access
+                        for block
+                        in build._blocks(io.BytesIO(data),  # pylint: disable=protected-access
+                                         build.BLOCK_SIZE))
+
+    results = {}
+    for name, func in (('line', per_line), ('block', per_block)):
+        elapsed, results[name] = _timeit(func)
+        print(f'{name}: {len(data) / 2 ** 20 / elapsed:.1f} MB/s')
+
+    if results['line'] != results['block']:
+        raise click.ClickException('outputs differ!')
+
+
+@main.command('normalize-fuzz')
+@click.option('--rounds', default=3000, show_default=True, type=click.INT)
+@click.option('--seed', default=0, show_default=True, type=click.INT)
+def bench_normalize_fuzz(rounds, seed):
+    '''
+    Check build block normalization against the per-line one, text mode
+    read, on small random wordlists: LF, CRLF and CR line endings, with
+    or without a last one, delimiters, blanks, accented letters and
+    lines that do not clean up, split in random block sizes.
+    '''
+
+    alphabet = "abcxyzXYZ-.' \t\x0b\x0c\x1c\u00e9\u00df\u00c51!"
+    rand = random.Random(seed)
+
+    for i in range(rounds):
+        text = ''.join(''.join(rand.choice(alphabet)
+                               for _ in range(rand.randint(0, 10)))
+                       + rand.choice(('\n', '\n', '\r\n', '\r'))
+                       for _ in range(rand.randint(0, 40)))
+        if rand.random() < 0.3:
+            text = text.rstrip('\r\n')
+        data = text.encode('utf-8')
+
+        lines = [line.rstrip('\n')
+                 for line
+                 in io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')]
+        normalized = list(map(build._normalize_line, lines))  # pylint: disable=protected-access
+        expected = (b''.join(x + b'\n' for x in normalized if x is not None),
+                    normalized.count(None))
+
+        blocks = [build._normalize_block(block)  # pylint: disable=protected-access
+                  for block
+                  in build._blocks(io.BytesIO(data),  # pylint: disable=protected-access
+                                   rand.randint(1, 64))]
+        result = (b''.join(x for x, _ in blocks), sum(x for _, x in blocks))
+
+        if result != expected:
+            raise click.ClickException(f'round {i}: {data!r} gives '
+                                       f'{result}, not {expected}')
+
+    print(f'{rounds} rounds ok')
+
+
+@main.command('ingest')
+@click.option('--docs',
+              help='synthetic airport documents count',
+              default=5000, show_default=True, type=click.INT)
+@click.option('--latency',
+              help='fake CouchDB per request latency, in ms',
+              default=1.0, show_default=True, type=click.FLOAT)
+@click.option('--changed',
+              help='ratio of documents changed on the update run',
+              default=0.1, show_default=True, type=click.FLOAT)
+@click.option('--engine',
+              type=click.Choice(['processes', 'asyncio']),
+              default='processes', show_default=True)
+@click.option('--concurrency',
+              help='asyncio engine concurrent requests',
+              default=8, show_default=True, type=click.INT)
+@click.option('--cache',
+              help='use an ingest.py documents cache',
+              is_flag=True, default=False)
+@click.option('--seed', default=0, show_default=True, type=click.INT)
+def bench_ingest(docs, latency, changed, engine, concurrency, cache, seed):  # pylint: disable=too-many-arguments, too-many-locals
+    '''
+    ingest.py docs/s against a local fake CouchDB: initial load,
+    unchanged reload and partial update.
+    '''
+
+    server = fakecouch.serve(latency=latency / 1000)
+    airports = _synthetic_airports(docs, seed)
+    rand = random.Random(seed)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        load = os.path.join(workdir, 'load.json')
+        with open(load, 'w') as output:
+            json.dump(airports, output)
+
+        update = os.path.join(workdir, 'update.json')
+        for airport in rand.sample(airports, int(docs * changed)):
+            airport['name'] += ' (changed)'
+        with open(update, 'w') as output:
+            json.dump(airports, output)
+
+        engine_args = ('--engine', engine, '--concurrency', str(concurrency))
+        if cache:
+            engine_args += ('--cache', os.path.join(workdir, 'cache.sqlite'))
+        for name, path, args in (('load', load, ()),
+                                 ('reload', load, ()),
+                                 ('update', update,
+                                  ('--when-existing', 'update'))):
+            requests = next(server.requests)
+            elapsed, _ = _timeit(_ingest, server.url, 'bench', path,
+                                 *engine_args, *args)
+            print(f'{name}: {docs / elapsed:.0f} docs/s, '
+                  f'{next(server.requests) - requests - 1} requests')
+
+    server.shutdown()
+
+
+def _parsed(path, mode, parse):
+    with open(path, mode) as data:
+        return sum(1 for _ in parse(data))
+
+
+@main.command('input')
+@click.option('--docs',
+              help='synthetic airport documents count',
+              default=15000, show_default=True, type=click.INT)
+@click.option('--pool-size',
+              help='ingest.py processes',
+              default=2, show_default=True, type=click.INT)
+@click.option('--seed', default=0, show_default=True, type=click.INT)
+def bench_input(docs, pool_size, seed):
+    '''
+    ingest.py input stage: in process parse rate of each input mode,
+    then docs/s of each against a local fake CouchDB.
+    '''
+
+    airports = _synthetic_airports(docs, seed)
+    server = fakecouch.serve()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        array = os.path.join(workdir, 'airports.json')
+        with open(array, 'w') as output:
+            json.dump(airports, output)
+
+        lines = os.path.join(workdir, 'airports.ndjson')
+        with open(lines, 'w') as output:
+            output.writelines(json.dumps(x) + '\n' for x in airports)
+
+        for name, path, mode, parse in (
+                ('json text', array, 'r',
+                 lambda data: ijson.items(data, 'item')),
+                ('json binary', array, 'rb',
+                 lambda data: ingest._parse(data, 'json', False)),  # pylint: disable=protected-access
+                ('ndjson', lines, 'rb',
+                 lambda data: ingest._parse(data, 'ndjson', False))):  # pylint: disable=protected-access
+            elapsed = min(_timeit(_parsed, path, mode, parse)[0]
+                          for _ in range(5))
+            print(f'parse {name}: {docs / elapsed:.0f} docs/s')
+
+        for name, path, args in (
+                ('json', array, ()),
+                ('ndjson', lines, ('--input-format', 'ndjson')),
+                ('ndjson split', lines, ('--input-format', 'ndjson',
+                                         '--input', lines))):
+            requests = next(server.requests)
+            elapsed, _ = _timeit(_ingest, server.url, name.replace(' ', '-'),
+                                 path, '--pool-size', str(pool_size), *args)
+            print(f'ingest {name}: {docs / elapsed:.0f} docs/s, '
+                  f'{next(server.requests) - requests - 1} requests')
+
+    server.shutdown()
+
+
+@main.command('split-fuzz')
+@click.option('--lines', 'max_lines',
+              help='lines per file, from 0 up to this',
+              default=40, show_default=True, type=click.INT)
+@click.option('--ranges', 'max_ranges',
+              help='ranges per file, from 1 up to this',
+              default=8, show_default=True, type=click.INT)
+@click.option('--seed', default=0, show_default=True, type=click.INT)
+def bench_split_fuzz(max_lines, max_ranges, seed):
+    '''
+    Check ingest.py split NDJSON input against sequential parsing: the
+    ranges cover the file and yield every document once, in order, with
+    the same offsets, and resuming a range from any offset yields the
+    rest of it. Files have blank lines and may lack a last newline.
+    '''
+
+    rand = random.Random(seed)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'input.ndjson')
+
+        for lines in range(max_lines):
+            with open(path, 'w') as output:
+                output.write(''.join(
+                    rand.choice(('', ' ', json.dumps({'n': i,
+                                                      's': 'x' * i})))
+                    + '\n'
+                    for i in range(lines)))
+                if rand.random() < 0.3:
+                    output.write(json.dumps({'n': 'last'}))
+
+            with open(path, 'rb') as data:
+                expected = list(ingest._ndjson(data))  # pylint: disable=protected-access
+
+            for count in range(1, max_ranges + 1):
+                ranges = ingest._ranges(path, count)  # pylint: disable=protected-access
+                if (ranges[0][0] != 0
+                        or ranges[-1][1] != os.path.getsize(path)
+                        or any(x[1] != y[0]
+                               for x, y in zip(ranges, ranges[1:]))):
+                    raise click.ClickException(
+                        f'{lines} lines, {count} ranges: bad ranges {ranges}')
+
+                result = []
+                for start, end in ranges:
+                    entries = list(ingest._ndjson(  # pylint: disable=protected-access
+                        ingest._lines(path, start, end), start))  # pylint: disable=protected-access
+                    result.extend(entries)
+
+                    for i, (offset, _) in enumerate(entries):
+                        if list(ingest._ndjson(  # pylint: disable=protected-access
+                                ingest._lines(path, offset, end),  # pylint: disable=protected-access
+                                offset)) != entries[i + 1:]:
+                            raise click.ClickException(
+                                f'{lines} lines, {count} ranges: resuming '
+                                f'[{start}, {end}) from {offset} differs')
+
+                if result != expected:
+                    raise click.ClickException(
+                        f'{lines} lines, {count} ranges: documents differ')
+
+    print(f'{max_lines} files, up to {max_ranges} ranges each: ok')
+
+
+@main.command('chunks')
+@click.option('--words',
+              help='candidate words count',
+              default=1000000, show_default=True, type=click.INT)
+@click.option('--codes',
+              help='synthetic IATA codes set size',
+              default=9000, show_default=True, type=click.INT)
+@click.option('--length',
+              help='candidate words length, in codes',
+              default=3, show_default=True, type=click.INT)
+@click.option('--seed', default=0, show_default=True, type=click.INT)
+def bench_chunks(words, codes, length, seed):
+    '''
+    Per-word cost of checking candidate words against a IATA codes set.
+    '''
+
+    if 'bitmap' not in iata_words.STRATEGIES:
+        raise click.ClickException('numpy is not installed')
+
+    iata_codes = _synthetic_codes(codes, seed)
+    rand = random.Random(seed)
+    candidates = [''.join(rand.choice(string.ascii_uppercase)
+                          for _ in range(length * 3))
+                  for _ in range(words)]
+    size = length * 3
+
+    def with_set():
+        return sum(1
+                   for word in candidates
+                   if iata_codes.issuperset(
+                       tuple(word[i:i + iata_words.IATA_CODE_LENGTH]
+                             for i in range(0, size,
+                                            iata_words.IATA_CODE_LENGTH))))
+
+    def with_bitmap():
+        bitmap = iata_words._bitmap(frozenset(iata_codes))  # pylint: disable=protected-access
+        batch = iata_words.BITMAP_BATCH_SIZE
+        return sum(len(iata_words._check_batch(  # pylint: disable=protected-access
+            candidates[i:i + batch], size, bitmap, iata_codes))
+                   for i in range(0, words, batch))
+
+    for name, func in (('set', with_set), ('bitmap', with_bitmap)):
+        elapsed, matches = _timeit(func)
+        print(f'{name}: {matches} matches, '
+              f'{elapsed / words * 1e9:.0f}ns per word')
+
+
+@main.command('load')
+@click.option('--tries',
+              help='wordlist tries path',
+              required=True, metavar='<path>')
+@click.option('--runs', default=5, show_default=True, type=click.INT)
+def bench_load(tries, runs):
+    '''
+    Compare trie startup time and RSS, loaded vs memory-mapped.
+
+    Every run happens in a fresh process; RSS is measured right after
+    loading and after a full keys walk (touching every page).
+    '''
+
+    context = multiprocessing.get_context('spawn')
+    print(f'trie size: {os.stat(tries).st_size // 1024} kB')
+
+    for mmap in (False, True):
+        for _ in range(runs):
+            parent, child = context.Pipe()
+            process = context.Process(target=_load_probe,
+                                      args=(tries, mmap, child))
+            process.start()
+            elapsed, loaded, walked = parent.recv()
+            process.join()
+            print(f'{"mmap" if mmap else "load"}: {elapsed * 1000:.2f}ms, '
+                  f'rss/anon/file kB loaded {loaded}, walked {walked}')
+
+
+async def _query(socket, port, target):
+    if socket:
+        reader, writer = await asyncio.open_unix_connection(socket)
+    else:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+    start = time.perf_counter()
+    writer.write(f'GET {target} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+    await writer.drain()
+    _, body = (await reader.read()).split(b'\r\n\r\n', 1)
+    writer.close()
+
+    return time.perf_counter() - start, body.count(b'\n')
+
+
+async def _load_test(socket, port, target, clients, requests):
+    async def client():
+        return [await _query(socket, port, target) for _ in range(requests)]
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(client() for _ in range(clients)))
+    return time.perf_counter() - start, [x for y in results for x in y]
+
+
+@main.command('server')
+@click.option('--socket',
+              help='iata_server unix socket path',
+              metavar='<path>')
+@click.option('--port',
+              help='iata_server localhost port, when no --socket is given',
+              default=8053, show_default=True, type=click.INT)
+@click.option('--query',
+              help='find query string',
+              default='min_size=6&max_size=9', show_default=True)
+@click.option('--clients', default=20, show_default=True, type=click.INT)
+@click.option('--requests', default=20, show_default=True, type=click.INT)
+def bench_server(socket, port, query, clients, requests):  # pylint: disable=too-many-arguments
+    '''
+    Load test a running iata_server, reporting latency percentiles.
+    '''
+
+    elapsed, results = asyncio.run(_load_test(socket, port, f'/find?{query}',
+                                              clients, requests))
+    latencies = sorted(x for x, _ in results)
+
+    def percentile(value):
+        return latencies[min(len(latencies) - 1,
+                             int(len(latencies) * value / 100))] * 1000
+
+    print(f'{len(results)} requests, {clients} clients in {elapsed:.2f}s '
+          f'({len(results) / elapsed:.1f} req/s), '
+          f'{results[0][1]} lines per response')
+    print(f'latency p50 {percentile(50):.2f}ms, p99 {percentile(99):.2f}ms, '
+          f'max {latencies[-1] * 1000:.2f}ms')
+
+
+@main.command('spider')
+@click.argument('pages', nargs=-1,
+                type=click.Path(exists=True, dir_okay=False))
+@click.option('--rows',
+              help='airports per synthetic page, when no pages are given',
+              default=676, show_default=True, type=click.IntRange(1, 676))
+@click.option('--runs', default=5, show_default=True, type=click.INT)
+def bench_spider(pages, rows, runs):
+    '''
+    IataSpider airports extraction rows/s over saved list pages, e.g.
+    scrapy HTTP cache response_body files, or fakewiki ones: one XPath
+    query per field vs a single pass over cells.
+    '''
+
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 '..', 'iata'))
+    from scrapy.http import HtmlResponse  # pylint: disable=import-outside-toplevel
+    from scrapeports.spiders import iata  # pylint: disable=import-outside-toplevel
+
+    if pages:
+        bodies = []
+        for path in pages:
+            with open(path, 'rb') as page:
+                bodies.append(page.read())
+    else:
+        server = fakewiki.serve(rows=rows)
+        bodies = [urllib.request.urlopen(  # nosec
+            f'{server.url}{fakewiki.LIST}{x}').read() for x in server.pages]
+        server.shutdown()
+
+    def responses():
+        return [HtmlResponse('http://localhost/', body=x, encoding='utf-8')
+                for x in bodies]
+
+    def parse():
+        return [response.selector for response in responses()]
+
+    def xpath():
+        return [iata._clean(iata._xpath_airport(row))  # pylint: disable=protected-access
+                for response in responses()
+                for row in response.xpath(iata.ROWS)]
+
+    def single():
+        return [iata._clean(iata._airport(row))  # pylint: disable=protected-access
+                for response in responses()
+                for row in response.selector.root.xpath(iata.ROWS)]
+
+    elapsed = min(_timeit(parse)[0] for _ in range(runs))
+    print(f'parse only: {elapsed * 1000:.1f}ms for {len(bodies)} pages')
+
+    results = {}
+    for name, func in (('xpath', xpath), ('single pass', single)):
+        elapsed = min(_timeit(func)[0] for _ in range(runs))
+        results[name] = func()
+        print(f'{name}: {elapsed * 1000:.1f}ms, '
+              f'{len(results[name]) / elapsed:.0f} rows/s')
+
+    if results['xpath'] != results['single pass']:
+        raise click.ClickException('airports differ!')
+
+
+SUITE = ('build', 'trie', 'find', 'ingest')
+
+
+def _suite_build(wordlist, codes_path, pool_size, tries, workdir):
+    report = os.path.join(workdir, 'build.json')
+    with open(wordlist) as data:
+        process = subprocess.run(
+            [sys.executable,
+             os.path.join(os.path.dirname(__file__), 'build.py'),
+             '--pool-size', str(pool_size), '--output', tries,
+             '--iata-codes', f'file://{codes_path}', '--report', report],
+            stdin=data, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            text=True)
+    if process.returncode:
+        raise click.ClickException(f'build failed:\n{process.stderr}')
+    return _report(report)
+
+
+def _suite_ingest(server, path, dbname, docs, engine, workdir):  # pylint: disable=too-many-arguments
+    report = os.path.join(workdir, 'ingest.json')
+    requests = next(server.requests)
+    _ingest(server.url, dbname, path, '--engine', engine, '--report', report)
+    result = _report(report)
+    return {'docs_per_second': docs / result['wall'],
+            'wall': result['wall'],
+            'requests': next(server.requests) - requests - 1,
+            'peak_rss_kib': result['peak_rss_kib']}
+
+
+@main.command('suite')
+@click.option('--output',
+              help='JSON results file, - for stdout',
+              default='-', show_default=True, metavar='<path>')
+@click.option('--only',
+              help='run only these benchmarks',
+              type=click.Choice(SUITE), multiple=True)
+@click.option('--size',
+              help='synthetic wordlist size, in MB',
+              default=20, show_default=True, type=click.INT)
+@click.option('--unicode-ratio',
+              help='ratio of wordlist lines with accented letters',
+              default=0.1, show_default=True, type=click.FLOAT)
+@click.option('--iata-ratio',
+              help='ratio of wordlist lines made of IATA codes',
+              default=0.01, show_default=True, type=click.FLOAT)
+@click.option('--codes',
+              help='synthetic IATA codes set size',
+              default=9000, show_default=True, type=click.INT)
+@click.option('--pool-size', 'pool_sizes',
+              help='build pool sizes to compare',
+              default=[1, 2, 4], show_default=True,
+              multiple=True, type=click.IntRange(min=1))
+@click.option('--find-size', 'find_sizes',
+              help='find() word sizes to time, as MIN:MAX',
+              default=['0:6', '6:9', '9:15', '0:inf'], show_default=True,
+              multiple=True, callback=_size_range)
+@click.option('--runs',
+              help='timed runs of in process benchmarks',
+              default=3, show_default=True, type=click.IntRange(min=1))
+@click.option('--docs',
+              help='synthetic airport documents count',
+              default=5000, show_default=True, type=click.INT)
+@click.option('--latency',
+              help='fake CouchDB per request latency, in ms',
+              default=1.0, show_default=True, type=click.FLOAT)
+@click.option('--seed', default=0, show_default=True, type=click.INT)
+def bench_suite(output, only, size, unicode_ratio,  # pylint: disable=too-many-arguments, too-many-locals
+                iata_ratio, codes, pool_sizes, find_sizes, runs,
+                docs, latency, seed):
+    '''
+    Reproducible benchmark of build, trie, find() and ingest on
+    synthetic data, saving results as JSON for compare.
+
+    Build and ingest run as tools, with their --report; trie and find()
+    run in fresh processes so that peak RSS is theirs alone.
+    '''
+
+    only = only or SUITE
+    iata_codes = _synthetic_codes(codes, seed)
+    results = {}
+
+    def record(name, result, summary):
+        results[name] = result
+        print(f'{name}: {summary}', file=sys.stderr)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        codes_path = os.path.join(workdir, 'codes.txt')
+        with open(codes_path, 'w') as codes_file:
+            codes_file.writelines(f'{x}\n' for x in sorted(iata_codes))
+
+        wordlist = os.path.join(workdir, 'wordlist.txt')
+        with open(wordlist, 'w', encoding='utf-8') as wordlist_file:
+            wordlist_file.write(_synthetic_lines(size * 2 ** 20, seed,
+                                                 unicode_ratio, iata_codes,
+                                                 iata_ratio))
+        wordlist_size = os.path.getsize(wordlist) / 2 ** 20
+
+        tries = os.path.join(workdir, 'wordlist.marisa')
+        if 'build' in only:
+            for pool_size in pool_sizes:
+                report = _suite_build(wordlist, codes_path, pool_size, tries,
+                                      workdir)
+                record(f'build/pool={pool_size}',
+                       {'mb_per_second': wordlist_size / report['wall'],
+                        'wall': report['wall'],
+                        'peak_rss_kib': report['peak_rss_kib'],
+                        'stages': {name: stage['wall']
+                                   for name, stage
+                                   in report['stages'].items()}},
+                       f'{wordlist_size / report["wall"]:.1f} MB/s')
+        elif {'trie', 'find'} & set(only):
+            _suite_build(wordlist, codes_path, max(pool_sizes), tries,
+                         workdir)
+
+        if 'trie' in only:
+            (timings, keys), rss = _isolated(_trie_probe, tries, runs)
+            record('trie',
+                   {'keys': keys, 'wall': _latencies(timings),
+                    'peak_rss_kib': rss},
+                   f'{keys} keys in {min(timings):.3f}s')
+
+        if 'find' in only:
+            for use_index in (True, False):
+                for min_size, max_size in find_sizes:
+                    (timings, words), rss = _isolated(
+                        _find_probe, tries, iata_codes, min_size, max_size,
+                        use_index, runs)
+                    record(f'find/{"index" if use_index else "walk"}/'
+                           f'{min_size}:{max_size:g}',
+                           {'words': words, 'wall': _latencies(timings),
+                            'peak_rss_kib': rss},
+                           f'{words} words in {min(timings) * 1000:.1f}ms')
+
+        if 'ingest' in only:
+            path = os.path.join(workdir, 'airports.json')
+            with open(path, 'w') as airports:
+                json.dump(_synthetic_airports(docs, seed), airports)
+
+            server = fakecouch.serve(latency=latency / 1000)
+            engines = ('processes', 'asyncio') if ingest.aiohttp \
+                else ('processes',)
+            for engine in engines:
+                for name in ('load', 'reload'):
+                    result = _suite_ingest(server, path, f'bench-{engine}',
+                                           docs, engine, workdir)
+                    record(f'ingest/{engine}/{name}', result,
+                           f'{result["docs_per_second"]:.0f} docs/s')
+            server.shutdown()
+
+    with click.open_file(output, 'w') as results_file:
+        json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                   'revision': _git_revision(),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'cpus': os.cpu_count(),
+                   'params': {'size': size, 'unicode_ratio': unicode_ratio,
+                              'iata_ratio': iata_ratio, 'codes': codes,
+                              'runs': runs, 'docs': docs,
+                              'latency': latency, 'seed': seed},
+                   'results': results}, results_file, indent=2)
+        results_file.write('\n')
+
+
+def _metrics(results, prefix=''):
+    for name, value in results.items():
+        if isinstance(value, dict):
+            yield from _metrics(value, f'{prefix}{name}.')
+        elif isinstance(value, (int, float)):
+            yield f'{prefix}{name}', value
+
+
+@main.command('compare')
+@click.argument('before', type=click.File())
+@click.argument('after', type=click.File())
+@click.option('--threshold',
+              help='flag changes for the worse above this ratio',
+              default=0.1, show_default=True, type=click.FLOAT)
+def bench_compare(before, after, threshold):
+    '''
+    Compare two suite results: timings and memory are better lower,
+    rates higher.
+    '''
+
+    before, after = json.load(before), json.load(after)
+    if before['params'] != after['params']:
+        print('warning: runs have different parameters', file=sys.stderr)
+
+    old = dict(_metrics(before['results']))
+    for name, value in _metrics(after['results']):
+        if name not in old or not old[name]:
+            continue
+        change = value / old[name] - 1
+        worse = -change if 'per_second' in name else change
+        flag = '!' if worse > threshold else ' '
+        print(f'{flag} {name}: {old[name]:.4g} -> {value:.4g} '
+              f'({change:+.1%})')
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
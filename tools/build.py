@@ -5,12 +5,20 @@ Created on 26 feb 2019
 @author: Alessandro Ogier <alessandro.ogier@gmail.com>
 '''
 import atexit
+import bz2
+import contextlib
 from glob import glob
+import heapq
+import io
+import itertools
+import gzip
 import logging
+import lzma
 import multiprocessing
 import os
 import re
 import shutil
+import string
 import sys
 import tempfile
 import unicodedata
@@ -19,12 +27,37 @@ import click
 import marisa_trie
 from setproctitle import setproctitle  # pylint: disable=no-name-in-module
 
+import iata_words
+import instrument
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 __ME__ = 'build'
 STOP = 'KTHXBYE'
 FNULL = open(os.devnull, 'w')
 CLEANED_RECORD = re.compile(br'^([A-Z]*\n?)+$')
 DELIMITERS = re.compile(br"[\.\-']")
+DELIMITERS_TABLE = bytes.maketrans(b".-'", b'\n\n\n')
+# a whole ASCII line that cleans up: what str.strip() would strip around
+# uppercase letters and delimiters
+ASCII_RECORD = re.compile(
+    br"^[ \t\x0b\x0c\x1c-\x1f]*([A-Z.'\-]*)[ \t\x0b\x0c\x1c-\x1f]*$", re.M)
+CLEAN_BYTES = string.ascii_uppercase.encode() + b".-'\n"
+NON_ASCII_LINE = re.compile(br'^.*[\x80-\xff].*$', re.M)
+BLOCK_SIZE = 2 ** 22
+INPUT_BATCH_SIZE = 2 ** 24
+CHUNK_SIZE = 10000000
+# str set memory over raw line size, roughly
+DEDUP_OVERHEAD = 10
+# share of --memory-limit batches in flight can take at most
+TRANSPORT_SHARE = 4
+MERGE_FAN_IN = 64
+MERGE_BUFFER_SIZE = 2 ** 20
+MAGIC_SIZE = 6
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)s %(message)s')
@@ -43,96 +76,455 @@ def _mktemp(prefix, mode='w'):
     return open(temporary_file, mode)
 
 
-def _dedup(in_queue):
+def _send(queue, data, prefix, inflight, budget):
+    '''
+    Hand a batch over to the next stage: in memory while the bytes in
+    flight fit the budget, spilled to a temp file otherwise.
+    '''
+
+    with inflight.get_lock():
+        in_memory = inflight.value + len(data) <= budget
+        if in_memory:
+            inflight.value += len(data)
+
+    if in_memory:
+        queue.put(data)
+        return
+
+    with _mktemp(prefix, 'wb') as spill:
+        spill.write(data)
+    queue.put(spill.name)
+
+
+@contextlib.contextmanager
+def _receive(item, inflight):
+    '''
+    Open a batch handed over by _send() as a binary file.
+    '''
+
+    if isinstance(item, bytes):
+        with inflight.get_lock():
+            inflight.value -= len(item)
+        yield io.BytesIO(item)
+        return
+
+    with open(item, 'rb') as datafile:
+        yield datafile
+    os.remove(item)
+
+
+def _zstd(datafile):
+    # stream readers do not readline()
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+        datafile, read_across_frames=True))
+
+
+# magic number -> streaming decompressor of a binary file
+DECOMPRESSORS = {
+    b'\x1f\x8b': lambda datafile: gzip.GzipFile(fileobj=datafile),
+    b'\xfd7zXZ\x00': lzma.LZMAFile,
+    b'BZh': bz2.BZ2File,
+    b'(\xb5/\xfd': _zstd,
+}
+
+
+def _decompressor(datafile):
+    '''
+    Decompressor for a buffered binary file by its first bytes, None if
+    it is not compressed.
+    '''
+
+    head = datafile.peek(MAGIC_SIZE)[:MAGIC_SIZE]
+    for magic, decompressor in DECOMPRESSORS.items():
+        if head.startswith(magic):
+            return decompressor
+    return None
+
+
+def _inputs(patterns):
+    '''
+    Input files of paths and glob patterns, - for stdin, with whether
+    they are compressed; stdin alone if there are none.
+    '''
+
+    decompressors = []
+    for pattern in patterns or ('-',):
+        if pattern == '-':
+            decompressors.append(('-', _decompressor(sys.stdin.buffer)))
+            continue
+
+        paths = sorted(glob(pattern, recursive=True))
+        if not paths:
+            raise click.BadParameter(f'{pattern}: no such file',
+                                     param_hint='INPUT')
+        for path in paths:
+            with open(path, 'rb') as datafile:
+                decompressors.append((path, _decompressor(datafile)))
+
+    if zstandard is None and any(x is _zstd for _, x in decompressors):
+        print('Error: you must install zstandard module '
+              'for zstd compressed input to work')
+        sys.exit(1)
+
+    return [(path, decompressor is not None)
+            for path, decompressor in decompressors]
+
+
+@contextlib.contextmanager
+def _open_input(path):
+    '''
+    Open an input file, or stdin for -, as a binary file decompressing
+    on the fly.
+    '''
+
+    with contextlib.ExitStack() as stack:
+        datafile = sys.stdin.buffer if path == '-' \
+            else stack.enter_context(open(path, 'rb'))
+        decompressor = _decompressor(datafile)
+        if decompressor is not None:
+            datafile = stack.enter_context(decompressor(datafile))
+        yield datafile
+
+
+def _ranges(path, size):
+    '''
+    Split a file into (path, start, end) byte ranges of about size bytes.
+    '''
+
+    total = os.path.getsize(path)
+    return [(path, start, min(start + size, total))
+            for start in range(0, total, size)]
+
+
+def _describe(item):
+    if isinstance(item, bytes):
+        return f'memory ({len(item)})'
+    return f'{os.path.basename(item)} ({os.stat(item).st_size})'
+
+
+def _dedup(in_queue, inflight):
 
     setproctitle(f'{__ME__} - deduplicator')
 
     logger.debug('dedup start!')
 
-    for item in iter(in_queue.get, STOP):
+    stage = instrument.stage('dedup')
 
-        entries = set()
-        with open(item, encoding='utf-8') as datafile:
-            entries.update((line for line in datafile))
+    for item in iter(in_queue.get, STOP):
 
-        dedup_log_from = f'{os.path.basename(item)} ({os.stat(item).st_size})'
-        os.remove(item)
-        with _mktemp('3-dedup-') as output:
-            for entry in entries:
-                output.write(entry)
-        output.close()
+        dedup_log_from = _describe(item)
+        with _receive(item, inflight) as datafile:
+            data = datafile.read()
+        entries = set(io.BytesIO(data))
+        lines = data.count(b'\n')
+
+        with _mktemp('3-dedup-', 'wb') as output:
+            output.writelines(sorted(entries))
+            stage.add(runs=1, lines_in=lines, lines_out=len(entries),
+                      dropped=lines - len(entries),
+                      bytes_in=len(data), bytes_out=output.tell())
         logger.debug('dedup: %s -> %s (%s)',
                      dedup_log_from,
                      os.path.basename(output.name),
                      os.stat(output.name).st_size)
 
+    stage.stop()
     logger.debug('dedup exit!')
 
 
-def _process(in_queue, out_queue):
+def _normalize_line(line):
+    '''
+    Normalize a text line into newline separated uppercase A-Z words,
+    None if it does not clean up.
+    '''
+
+    line = line.strip()
+    line = unicodedata.normalize(
+        'NFKD', line).encode('ascii', 'ignore')
+    line = line.upper()
+    line = DELIMITERS.split(line)
+    ret = b'\n'.join(line)
+    if CLEANED_RECORD.match(ret):
+        return ret
+
+    return None
+
+
+def _normalize_ascii(block):
+    if not block:
+        return b'', 0
+
+    if not block.endswith(b'\n'):
+        block += b'\n'
+
+    block = block.upper()
+
+    # nothing to strip or to drop
+    if not block.translate(None, CLEAN_BYTES):
+        return block.translate(DELIMITERS_TABLE), 0
+
+    records = ASCII_RECORD.findall(block[:-1])
+    dropped = block.count(b'\n') - len(records)
+    if not records:
+        return b'', dropped
+
+    return ((b'\n'.join(records) + b'\n').translate(DELIMITERS_TABLE),
+            dropped)
+
+
+def _normalize_block(block):
+    '''
+    Normalize a block of whole lines at once, same output as
+    _normalize_line() over every line, and count the lines that did not
+    clean up. Only non-ASCII lines need the per-line NFKD path.
+    '''
+
+    # universal newlines, as text mode reading would do
+    block = block.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+
+    if block.isascii():
+        return _normalize_ascii(block)
+
+    output = []
+    dropped = 0
+    position = 0
+    for match in NON_ASCII_LINE.finditer(block):
+        ascii_output, ascii_dropped = _normalize_ascii(
+            block[position:match.start()])
+        output.append(ascii_output)
+        dropped += ascii_dropped
+        ret = _normalize_line(match.group().decode('utf-8'))
+        if ret is not None:
+            output.append(ret + b'\n')
+        else:
+            dropped += 1
+        position = match.end() + 1
+    ascii_output, ascii_dropped = _normalize_ascii(block[position:])
+    output.append(ascii_output)
+
+    return b''.join(output), dropped + ascii_dropped
+
+
+def _blocks(datafile, size):
+    '''
+    Read a binary file in blocks of about size bytes, ending on a
+    line boundary.
+    '''
+    for block in iter(lambda: datafile.read(size), b''):
+        yield block + datafile.readline()
+
+
+def _range_blocks(path, start, end, size):
+    '''
+    Read the lines of a file starting within the start:end byte range, in
+    blocks of about size bytes ending on a line boundary.
+    '''
+
+    with open(path, 'rb') as datafile:
+        if start:
+            # the line across start belongs to the previous range
+            datafile.seek(start - 1)
+            datafile.readline()
+
+        position = datafile.tell()
+        while position < end:
+            block = datafile.read(min(size, end - position))
+            if not block:
+                break
+            if not block.endswith(b'\n'):
+                block += datafile.readline()
+            position += len(block)
+            yield block
+
+
+def _batch_blocks(item, inflight, size):
+    '''
+    Blocks of whole lines of a batch: handed over by _send(), or an input
+    file byte range to read in place.
+    '''
+
+    if isinstance(item, tuple):
+        yield from _range_blocks(*item, size)
+        return
+
+    with _receive(item, inflight) as work:
+        yield from _blocks(work, size)
+
+
+def _process(in_queue, out_queue,  # pylint: disable=too-many-arguments
+             chunk_size, inflight, budget):
 
     setproctitle(f'{__ME__} - processor')
 
     logger.debug('processor started!')
 
-    for item in iter(in_queue.get, STOP):
+    stage = instrument.stage('process')
 
-        with open(item, encoding='utf-8') as work:
-            wordlist = _mktemp('1-clean-', 'wb')
-            for line in work:
-
-                line = line.strip()
-                line = unicodedata.normalize(
-                    'NFKD', line).encode('ascii', 'ignore')
-                line = line.upper()
-                line = DELIMITERS.split(line)
-                ret = b'\n'.join(line)
-                if CLEANED_RECORD.match(ret):
-                    wordlist.write(ret + b'\n')
-                else:
-                    #                     logger.warning('Dropping %s', line)
-                    pass
-                if wordlist.tell() > 10000000:
-                    wordlist.close()
-                    logger.debug('rotating output')
-                    out_queue.put(wordlist.name)
-
-                    wordlist = _mktemp('1-clean-', 'wb')
-
-            if wordlist.tell() > 0:
-                wordlist.close()
-                logger.debug('send last piece')
-                out_queue.put(wordlist.name)
-
-        os.remove(item)
+    for item in iter(in_queue.get, STOP):
 
+        wordlist = []
+        size = 0
+        for block in _batch_blocks(item, inflight,
+                                   min(BLOCK_SIZE, chunk_size)):
+
+            normalized, dropped = _normalize_block(block)
+            wordlist.append(normalized)
+            size += len(normalized)
+            stage.add(lines_in=block.count(b'\n'),
+                      lines_out=normalized.count(b'\n'),
+                      dropped=dropped,
+                      bytes_in=len(block), bytes_out=len(normalized))
+
+            if size > chunk_size:
+                logger.debug('rotating output')
+                _send(out_queue, b''.join(wordlist), '1-clean-',
+                      inflight, budget)
+
+                wordlist = []
+                size = 0
+
+        if size > 0:
+            logger.debug('send last piece')
+            _send(out_queue, b''.join(wordlist), '1-clean-',
+                  inflight, budget)
+
+    stage.stop()
     logger.debug('processor end!')
 
 
-def _generate(workdir):
-    for file in glob(f'{workdir}/3-dedup-*'):
-        with open(file, encoding='utf-8') as datafile:
-            try:
-                for line in datafile:
-                    yield line.strip()
-            except Exception as err:
-                logger.critical('OH NO, %s', err)
-                raise
+def _merge(runs, buffer_size):
+    '''
+    k-way merge of sorted runs, yielding unique lines.
+    '''
+    stage = instrument.stage('merge')
+    files = [open(run, encoding='utf-8', buffering=buffer_size)
+             for run in runs]
+    lines_in = lines_out = 0
+    try:
+        previous = None
+        for line in heapq.merge(*files):
+            lines_in += 1
+            if line != previous:
+                lines_out += 1
+                yield line
+                previous = line
+    finally:
+        for datafile in files:
+            datafile.close()
+        stage.add(runs=len(runs), lines_in=lines_in, lines_out=lines_out,
+                  dropped=lines_in - lines_out)
+
+
+def _generate(workdir, fan_in, buffer_size):
+    '''
+    Merge sorted dedup runs, at most fan_in at a time, into a globally
+    sorted and unique words stream.
+    '''
+    runs = glob(f'{workdir}/3-dedup-*')
+
+    while len(runs) > fan_in:
+        logger.debug('merging %s runs', len(runs))
+        merged = []
+        for i in range(0, len(runs), fan_in):
+            with _mktemp('4-merge-') as output:
+                output.writelines(_merge(runs[i:i + fan_in], buffer_size))
+            for run in runs[i:i + fan_in]:
+                os.remove(run)
+            merged.append(output.name)
+        runs = merged
+
+    logger.debug('final merge of %s runs', len(runs))
+    try:
+        for line in _merge(runs, buffer_size):
+            yield line.strip()
+    except Exception as err:
+        logger.critical('OH NO, %s', err)
+        raise
+
+
+def _normalized_words(path):
+    '''
+    Normalize a wordlist file the way the build pipeline does, into a set
+    of trie keys.
+    '''
+
+    with _open_input(path) as datafile:
+        return set(b''.join(_normalize_block(block)[0]
+                            for block
+                            in _blocks(datafile, BLOCK_SIZE))
+                   .decode('ascii').splitlines())
+
+
+def _incremental(base, add, remove):
+    '''
+    Build a trie from an existing one plus added and removed words files,
+    in a single pass over the existing keys.
+    '''
+
+    trie = marisa_trie.Trie().load(base)
+
+    added = _normalized_words(add) if add else set()
+    removed = (_normalized_words(remove) if remove else set()) - added
+    added = set(word for word in added if word not in trie)
+
+    logger.debug('updating %s words trie: %s words added, %s removed',
+                 len(trie), len(added),
+                 sum(1 for word in removed if word in trie))
+
+    keys = (key for key in trie.iterkeys() if key not in removed)
+
+    return marisa_trie.Trie(itertools.chain(keys, added))
+
+
+def _save(trie, output, iata_codes):
 
+    logger.debug('saving trie')
+    with instrument.stage('save') as stage:
+        trie.save(output)
+        stage.add(keys=len(trie), bytes_out=os.path.getsize(output))
 
-@click.command()
-@click.option('--pool-size',
-              help='processor pool size',
-              type=click.INT, default=3)
-@click.option('--keep',
-              help='keep workdir',
-              is_flag=True)
-@click.option('--output',
-              help='output file name',
-              required=True)
-def main(pool_size, keep, output):
+    if iata_codes:
+        logger.debug('making IATA words index')
+        with instrument.stage('index') as stage:
+            index = iata_words.build_index(trie, iata_codes)
+            index.save(output + iata_words.INDEX_SUFFIX)
+            stage.add(keys=len(index))
+
+    logger.debug('done')
 
-    setproctitle(f'{__ME__} - main process')
+
+def _read(inputs, process_queue, dedup_queue, inflight, budget):
+    '''
+    Hand inputs over to the processors: byte ranges of plain files, read
+    in place, and batches of the others as they are decompressed.
+    '''
+
+    with instrument.stage('read') as stage:
+        for path, compressed in inputs:
+
+            if not compressed and path != '-' and os.path.isfile(path):
+                for batch in _ranges(path, INPUT_BATCH_SIZE):
+                    logger.debug('sending input range %s', batch)
+                    process_queue.put(batch)
+                    stage.add(ranges=1, bytes_in=batch[2] - batch[1])
+                    with contextlib.suppress(NotImplementedError):
+                        stage.peak(process_queue=process_queue.qsize(),
+                                   dedup_queue=dedup_queue.qsize())
+                continue
+
+            with _open_input(path) as datafile:
+                for batch in _blocks(datafile, INPUT_BATCH_SIZE):
+                    logger.debug('sending input batch at %s bytes',
+                                 len(batch))
+                    _send(process_queue, batch, '0-input-', inflight, budget)
+                    stage.add(batches=1, bytes_in=len(batch))
+                    with contextlib.suppress(NotImplementedError):
+                        stage.peak(process_queue=process_queue.qsize(),
+                                   dedup_queue=dedup_queue.qsize())
+
+
+def _build(pool_size, keep, memory_limit,  # pylint: disable=too-many-arguments, too-many-locals
+           transport_budget, output, iata_codes, inputs):
 
     workdir = tempfile.mkdtemp(suffix='-wordlist-build')
     logger.debug('workdir: %s', {workdir})
@@ -142,8 +534,21 @@ def main(pool_size, keep, output):
     if not keep:
         atexit.register(_exit_handler, workdir)
 
-    _, filename = tempfile.mkstemp(prefix='0-input-')
-    input_file = open(filename, 'w')
+    chunk_size = CHUNK_SIZE
+    buffer_size = MERGE_BUFFER_SIZE
+    budget = transport_budget * 2 ** 20
+    if memory_limit:
+        limit = memory_limit * 2 ** 20
+        # batches in flight take up to a share of the limit, deduplicators
+        # the rest, each holding a chunk as a set of str; the final merge,
+        # once they are all done, holds a read buffer per run
+        budget = min(budget, limit // TRANSPORT_SHARE)
+        chunk_size = min(chunk_size,
+                         (limit - budget) // (pool_size * DEDUP_OVERHEAD))
+        buffer_size = min(buffer_size, limit // (MERGE_FAN_IN * 2))
+        logger.debug('chunk size: %s, merge buffer size: %s, transport '
+                     'budget: %s', chunk_size, buffer_size, budget)
+    inflight = multiprocessing.Value('q', 0)
 
     process_queue = multiprocessing.Queue()
     dedup_queue = multiprocessing.Queue(20)
@@ -151,34 +556,23 @@ def main(pool_size, keep, output):
     dedup_pool = []
     process_pool = []
 
+    context = instrument.context()
+
     for _ in range(pool_size):
-        process = multiprocessing.Process(target=_process,
-                                          args=(process_queue, dedup_queue))
-        dedup_process = multiprocessing.Process(target=_dedup,
-                                                args=(dedup_queue, ))
+        process = multiprocessing.Process(target=instrument.run,
+                                          args=(context, _process,
+                                                process_queue, dedup_queue,
+                                                chunk_size, inflight, budget))
+        dedup_process = multiprocessing.Process(target=instrument.run,
+                                                args=(context, _dedup,
+                                                      dedup_queue, inflight))
         process.start()
         dedup_process.start()
 
         process_pool.append(process)
         dedup_pool.append(dedup_process)
 
-    for count, line in enumerate(sys.stdin, 1):
-        input_file.write(line)
-        if count % 2500000 == 0:
-            input_file.close()
-            logger.debug('rotating input file at %s bytes',
-                         os.stat(input_file.name).st_size)
-
-            process_queue.put(input_file.name)
-
-            _, filename = tempfile.mkstemp(prefix='0-input-')
-            input_file = open(filename, 'w')
-
-    if input_file.tell() > 0:
-        logger.debug('sending last input file at %s bytes',
-                     os.stat(input_file.name).st_size)
-        input_file.close()
-        process_queue.put(input_file.name)
+    _read(inputs, process_queue, dedup_queue, inflight, budget)
 
     for _ in range(pool_size):
         process_queue.put(STOP)
@@ -195,11 +589,83 @@ def main(pool_size, keep, output):
     logger.info('done')
 
     logger.debug('making trie')
-    trie = marisa_trie.Trie(_generate(workdir))
+    with instrument.stage('trie') as stage:
+        trie = marisa_trie.Trie(_generate(workdir, MERGE_FAN_IN, buffer_size))
+        stage.add(keys=len(trie))
 
-    logger.debug('saving trie')
-    trie.save(output)
-    logger.debug('done')
+    _save(trie, output, iata_codes)
+
+
+@click.command()
+@click.argument('inputs', nargs=-1, metavar='[INPUT]...')
+@click.option('--pool-size',
+              help='processor pool size',
+              type=click.INT, default=3)
+@click.option('--keep',
+              help='keep workdir',
+              is_flag=True)
+@click.option('--memory-limit',
+              help='memory budget in MB for deduplication, merging and '
+              'batches handed over between stages, not counting the trie '
+              'itself',
+              type=click.IntRange(min=1), metavar='<MB>')
+@click.option('--transport-budget',
+              help='memory budget in MB for batches handed over between '
+              'stages, above which they are spilled to temp files; with '
+              f'--memory-limit, up to 1/{TRANSPORT_SHARE} of it',
+              default=256, show_default=True,
+              type=click.IntRange(min=0), metavar='<MB>')
+@click.option('--output',
+              help='output file name',
+              required=True)
+@click.option('--iata-codes',
+              help='IATA codes list URL. Either file:// or couchdb(s):// ATM. '
+              f'If given, also build the output{iata_words.INDEX_SUFFIX} '
+              'IATA words index',
+              metavar='<url>',
+              callback=iata_words._iata_codes_callback)  # pylint: disable=protected-access
+@iata_words.codes_cache_options
+@click.option('--update',
+              help='incrementally update this existing trie with --add '
+              'and --remove words instead of reading inputs',
+              type=click.Path(exists=True, dir_okay=False), metavar='<path>')
+@click.option('--add',
+              help='with --update, wordlist file of words to add',
+              type=click.Path(exists=True, dir_okay=False), metavar='<path>')
+@click.option('--remove',
+              help='with --update, wordlist file of words to remove',
+              type=click.Path(exists=True, dir_okay=False), metavar='<path>')
+@instrument.options
+def main(inputs, pool_size, keep, memory_limit,  # pylint: disable=too-many-arguments, too-many-locals
+         transport_budget, output, iata_codes,
+         update, add, remove, progress, report, profile):
+    '''
+    Build a words trie out of INPUT wordlist files or glob patterns, or
+    stdin if none or -. gzip, xz, bzip2 and zstd compressed ones are
+    decompressed on the fly.
+    '''
+
+    setproctitle(f'{__ME__} - main process')
+
+    if (add or remove) and not update:
+        raise click.UsageError('--add and --remove require --update')
+
+    if update and inputs:
+        raise click.UsageError('--update takes no INPUT, see --add and '
+                               '--remove')
+
+    if not update:
+        inputs = _inputs(inputs)
+
+    with instrument.Session(__ME__, progress, report, profile):
+        if update:
+            with instrument.stage('update') as stage:
+                trie = _incremental(update, add, remove)
+                stage.add(keys=len(trie))
+            _save(trie, output, iata_codes)
+        else:
+            _build(pool_size, keep, memory_limit, transport_budget,
+                   output, iata_codes, inputs)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+'''
+Created on 18 oct 2026
+
+@author: Alessandro Ogier <alessandro.ogier@gmail.com>
+
+A tiny in-memory CouchDB stand-in, good enough for benchmarking and
+exercising the ingest tools locally. Only the endpoints those use are
+implemented.
+'''
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, unquote, urlparse
+import uuid
+
+import click
+
+
+class FakeCouch(ThreadingHTTPServer):
+    '''
+    Databases are dicts of documents, shared by all request threads.
+
+    Any view emits documents _id as keys, with null values.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0):
+        super().__init__(address, _Handler)
+        self.latency = latency
+        self.databases = {}
+        self.lock = threading.Lock()
+        self.requests = itertools.count()
+        self.update_seq = itertools.count(1)
+        self.seqs = {}
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server_address[:2]
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def _reply(self, status, body, headers=()):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length)
+        if 'json' not in self.headers.get('Content-Type', ''):
+            return {}
+        return json.loads(data)
+
+    def _route(self):
+        next(self.server.requests)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        url = urlparse(self.path)
+        parts = [unquote(x) for x in url.path.split('/') if x]
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+        with self.server.lock:
+            self._dispatch(parts, query)
+
+    def _dispatch(self, parts, query):  # pylint: disable=too-many-return-statements, too-many-branches
+        server = self.server
+        method = self.command
+
+        if not parts:
+            return self._reply(200, {'couchdb': 'Welcome', 'version': '2.3.1'})
+
+        if parts == ['_session']:
+            if method == 'POST':
+                self._body()
+            return self._reply(200, {'ok': True, 'userCtx': {'name': 'admin'}},
+                               [('Set-Cookie', 'AuthSession=fake; Path=/')])
+
+        if parts == ['_all_dbs']:
+            return self._reply(200, sorted(server.databases))
+
+        dbname, rest = parts[0], parts[1:]
+
+        if not rest:
+            if method == 'PUT':
+                if dbname in server.databases:
+                    return self._reply(412, {'error': 'file_exists'})
+                server.databases[dbname] = {}
+                server.seqs[dbname] = 0
+                return self._reply(201, {'ok': True})
+            if dbname not in server.databases:
+                return self._reply(404, {'error': 'not_found'})
+            if method == 'DELETE':
+                del server.databases[dbname]
+                return self._reply(200, {'ok': True})
+            return self._reply(200, {'db_name': dbname,
+                                     'doc_count': len(server.databases[dbname]),
+                                     'update_seq': f'{server.seqs[dbname]}-fake'})
+
+        if dbname not in server.databases:
+            return self._reply(404, {'error': 'not_found',
+                                     'reason': 'Database does not exist.'})
+        database = server.databases[dbname]
+
+        if rest == ['_all_docs']:
+            keys = self._body().get('keys') if method == 'POST' else None
+            include_docs = query.get('include_docs') == 'true'
+            return self._reply(200, {'rows': [self._row(database, key,
+                                                        include_docs)
+                                              for key
+                                              in (sorted(database)
+                                                  if keys is None
+                                                  else keys)]})
+
+        if rest == ['_bulk_docs'] and method == 'POST':
+            return self._reply(201, [self._save(dbname, doc)
+                                     for doc in self._body()['docs']])
+
+        if len(rest) == 4 and rest[0] == '_design' and rest[2] == '_view':
+            return self._view(dbname, query)
+
+        docid = '/'.join(rest)
+
+        if method in ('GET', 'HEAD'):
+            if docid not in database:
+                return self._reply(404, {'error': 'not_found',
+                                         'reason': 'missing'})
+            return self._reply(200, database[docid])
+
+        if method == 'PUT':
+            doc = self._body()
+            doc['_id'] = docid
+            result = self._save(dbname, doc)
+            return self._reply(409 if 'error' in result else 201, result)
+
+        if method == 'DELETE':
+            result = self._save(dbname, {'_id': docid,
+                                           '_rev': query.get('rev'),
+                                           '_deleted': True})
+            return self._reply(409 if 'error' in result else 200, result)
+
+        return self._reply(405, {'error': 'method_not_allowed'})
+
+    @staticmethod
+    def _row(database, key, include_docs):
+        if key not in database:
+            return {'key': key, 'error': 'not_found'}
+        row = {'id': key, 'key': key,
+               'value': {'rev': database[key]['_rev']}}
+        if include_docs:
+            row['doc'] = database[key]
+        return row
+
+    def _view(self, dbname, query):
+        etag = f'"{dbname}-{self.server.seqs[dbname]}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+
+        keys = sorted(x for x in self.server.databases[dbname]
+                      if not x.startswith('_design/'))
+        total = len(keys)
+        if 'startkey' in query:
+            startkey = json.loads(query['startkey'])
+            keys = [x for x in keys if x >= startkey]
+        keys = keys[int(query.get('skip', 0)):]
+        if 'limit' in query:
+            keys = keys[:int(query['limit'])]
+
+        return self._reply(200, {'total_rows': total, 'offset': 0,
+                                 'rows': [{'id': x, 'key': x, 'value': None}
+                                          for x in keys]},
+                           [('ETag', etag)])
+
+    def _save(self, dbname, doc):
+        database = self.server.databases[dbname]
+        docid = doc.setdefault('_id', uuid.uuid4().hex)
+        current = database.get(docid)
+
+        if (current or {}).get('_rev') != doc.get('_rev'):
+            return {'id': docid, 'error': 'conflict',
+                    'reason': 'Document update conflict.'}
+
+        generation = int(doc['_rev'].split('-')[0]) if current else 0
+        rev = f'{generation + 1}-{uuid.uuid4().hex}'
+        self.server.seqs[dbname] = next(self.server.update_seq)
+
+        if doc.get('_deleted'):
+            del database[docid]
+        else:
+            database[docid] = dict(doc, _rev=rev)
+
+        return {'ok': True, 'id': docid, 'rev': rev}
+
+    do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = _route
+
+
+def serve(port=0, latency=0.0):
+    '''
+    Start a FakeCouch server in a background thread and return it.
+
+    :param port: TCP port on localhost, 0 for any free one
+    :param latency: seconds to wait before answering each request
+    '''
+
+    server = FakeCouch(('127.0.0.1', port), latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+@click.command()
+@click.option('--port', default=5984, show_default=True, type=click.INT)
+@click.option('--latency',
+              help='per request latency, in ms',
+              default=0.0, show_default=True, type=click.FLOAT)
+def main(port, latency):
+    '''
+    Run a fake in-memory CouchDB server.
+    '''
+
+    server = FakeCouch(('127.0.0.1', port), latency / 1000)
+    print(f'serving on {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+'''
+Created on 18 oct 2026
+
+@author: Alessandro Ogier <alessandro.ogier@gmail.com>
+
+A tiny stand-in for the Wikipedia IATA airport code pages, good enough
+for exercising the scrapeports spider locally: an index page linking to
+one list page per letter, each with a sortable table of airports.
+
+Pages answer conditional requests the way MediaWiki does, with an ETag
+carrying the revision id, Last-Modified and a must-revalidate
+Cache-Control; edit() makes a new revision of a page.
+'''
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import random
+import string
+import threading
+import time
+
+import click
+
+
+INDEX = '/wiki/IATA_airport_code'
+LIST = '/wiki/List_of_airports_by_IATA_code:_'
+CACHE_CONTROL = 'private, s-maxage=0, max-age=0, must-revalidate'
+
+
+class _Page:
+
+    def __init__(self, rows, revision):
+        self.rows = rows
+        self.revision = revision
+        self.modified = time.time()
+
+    @property
+    def etag(self):
+        return f'W/"{self.revision}"'
+
+
+class FakeWiki(ThreadingHTTPServer):
+    '''
+    Pages are generated once from seed and only change through edit().
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, address, pages=26, rows=100, seed=0):
+        super().__init__(address, _Handler)
+        rand = random.Random(seed)
+        self.revisions = itertools.count(1)
+        self.lock = threading.Lock()
+        self.requests = itertools.count()
+        self.pages = {letter: _Page(_rows(rand, letter, rows),
+                                    next(self.revisions))
+                      for letter in string.ascii_uppercase[:pages]}
+
+    def handle_error(self, request, client_address):
+        pass
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server_address[:2]
+
+    @property
+    def start_url(self):
+        return self.url + INDEX
+
+    def edit(self, letter):
+        '''
+        Rename the first airport of a letter page, as a new revision.
+        '''
+
+        with self.lock:
+            page = self.pages[letter]
+            row = page.rows[0]
+            page.rows[0] = row[:2] + (f'{row[2]} (rev {page.revision})',) \
+                + row[3:]
+            page.revision = next(self.revisions)
+            page.modified = time.time()
+
+
+def _rows(rand, letter, count):
+    codes = sorted(rand.sample([letter + ''.join(x)
+                                for x
+                                in itertools.product(string.ascii_uppercase,
+                                                     repeat=2)],
+                               min(count, 26 * 26)))
+    return [(code,
+             rand.choice(string.ascii_uppercase) + code,
+             f'{code.title()} Airport',
+             f'{code.title()}ville, Somewhere',
+             f'UTC{rand.randint(-12, 12):+03d}:00',
+             rand.choice(['', 'E', 'A', 'U']))
+            for code in codes]
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def _reply(self, status, body=b'', headers=()):
+        self.send_response(status)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _unchanged(self, page):
+        etags = self.headers.get('If-None-Match')
+        if etags is not None:
+            return page.etag in [x.strip() for x in etags.split(',')]
+
+        since = self.headers.get('If-Modified-Since')
+        if since is not None:
+            try:
+                return int(page.modified) <= \
+                    parsedate_to_datetime(since).timestamp()
+            except (TypeError, ValueError):
+                return False
+
+        return False
+
+    def do_GET(self):  # pylint: disable=invalid-name, missing-docstring
+        next(self.server.requests)
+
+        if self.path == INDEX:
+            links = ''.join(f'<li><a href="{LIST}{x}">{x}</a></li>'
+                            for x in self.server.pages)
+            return self._html(f'<div class="mw-parser-output"><ul>{links}'
+                              '</ul></div>')
+
+        if not self.path.startswith(LIST):
+            return self._reply(404, b'not found')
+
+        with self.server.lock:
+            page = self.server.pages.get(self.path[len(LIST):])
+            if page is None:
+                return self._reply(404, b'not found')
+
+            headers = [('ETag', page.etag),
+                       ('Last-Modified', formatdate(page.modified,
+                                                    usegmt=True)),
+                       ('Cache-Control', CACHE_CONTROL)]
+
+            if self._unchanged(page):
+                return self._reply(304, headers=headers)
+
+            rows = ''.join('<tr>' + ''.join(f'<td>{x}</td>' for x in row)
+                           + '</tr>\n'
+                           for row in page.rows)
+
+        return self._html('<div class="mw-parser-output">'
+                          '<table class="wikitable sortable">'
+                          '<tr><th>IATA</th><th>ICAO</th><th>Airport name</th>'
+                          '<th>Location served</th><th>Time</th><th>DST</th>'
+                          f'</tr>\n{rows}</table></div>', headers)
+
+    do_HEAD = do_GET
+
+    def _html(self, body, headers=()):
+        return self._reply(200,
+                           f'<html><body>{body}</body></html>'.encode(),
+                           [('Content-Type', 'text/html; charset=UTF-8'),
+                            *headers])
+
+
+def serve(port=0, pages=26, rows=100, seed=0):
+    '''
+    Start a FakeWiki server in a background thread and return it.
+
+    :param port: TCP port on localhost, 0 for any free one
+    :param pages: letter pages, from A
+    :param rows: airports per page, up to 676
+    :param seed: airports generation seed
+    '''
+
+    server = FakeWiki(('127.0.0.1', port), pages, rows, seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+@click.command()
+@click.option('--port', default=8080, show_default=True, type=click.INT)
+@click.option('--pages', default=26, show_default=True,
+              type=click.IntRange(1, 26))
+@click.option('--rows', default=100, show_default=True,
+              type=click.IntRange(1, 26 * 26))
+@click.option('--seed', default=0, show_default=True, type=click.INT)
+def main(port, pages, rows, seed):
+    '''
+    Run a fake Wikipedia IATA airport codes site.
+    '''
+
+    server = FakeWiki(('127.0.0.1', port), pages, rows, seed)
+    print(f'serving on {server.start_url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
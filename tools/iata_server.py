@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+'''
+Created on 18 oct 2026
+
+@author: Alessandro Ogier <alessandro.ogier@gmail.com>
+
+Keep a trie and a IATA codes set warm and answer find queries over HTTP,
+either on a unix socket or on localhost:
+
+    GET /find?min_size=6&max_size=9&format=spaced&codes=FCO,MXP,...
+
+Results are streamed one word per line.
+'''
+import asyncio
+import functools
+import itertools
+import logging
+from urllib.parse import parse_qs, urlparse
+
+import click
+
+import iata_words
+
+
+__ME__ = 'iata_server'
+BATCH_SIZE = 1000
+FORMATS = {
+    'plain': ''.join,
+    'spaced': ' '.join,
+}
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s %(message)s')
+
+logger = logging.getLogger(__ME__)  # pylint: disable=invalid-name
+logger.setLevel(logging.INFO)
+
+
+class BadRequest(Exception):
+    '''
+    Invalid query.
+    '''
+
+
+def _parse_query(query, iata_codes):
+    '''
+    Validate query string parameters into search() arguments.
+    '''
+
+    query = parse_qs(query)
+    params = {k: v[-1] for k, v in query.items()}
+
+    try:
+        min_size = int(params.get('min_size', 0))
+        max_size = float(params.get('max_size', 'inf'))
+    except ValueError as err:
+        raise BadRequest(err) from err
+
+    _format = params.get('format', 'plain')
+    if _format not in FORMATS:
+        raise BadRequest(f'unknown format {_format}')
+
+    strategy = params.get('strategy', 'walk')
+    if strategy not in iata_words.STRATEGIES:
+        raise BadRequest(f'unknown strategy {strategy}')
+
+    if 'codes' in params:
+        iata_codes = iata_codes & frozenset(
+            code
+            for value in query['codes']
+            for code in value.upper().split(',')
+            if code)
+
+    return (iata_codes, min_size, max_size, strategy), FORMATS[_format]
+
+
+async def _respond(writer, status, body=b''):
+    writer.write(f'HTTP/1.1 {status}\r\n'
+                 'Content-Type: text/plain; charset=utf-8\r\n'
+                 'Connection: close\r\n\r\n'.encode() + body)
+    await writer.drain()
+
+
+def _take(words, _format):
+    '''
+    Search up to the next BATCH_SIZE words, formatted.
+    '''
+
+    return [_format(word) for word in itertools.islice(words, BATCH_SIZE)]
+
+
+async def _handle(trie, index, iata_codes, reader, writer):
+    '''
+    Serve a single request, streaming results in BATCH_SIZE lines chunks.
+
+    The search itself runs in the default executor, a chunk at a time: a
+    query finding few words in a large trie does not hold the event loop
+    and every other client until it is done.
+    '''
+
+    try:
+        request = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+
+        try:
+            method, target, _ = request.decode('latin-1').split()
+        except ValueError:
+            await _respond(writer, '400 Bad Request', b'malformed request\n')
+            return
+
+        url = urlparse(target)
+        if method != 'GET' or url.path != '/find':
+            await _respond(writer, '404 Not Found')
+            return
+
+        try:
+            args, _format = _parse_query(url.query, iata_codes)
+        except BadRequest as err:
+            await _respond(writer, '400 Bad Request', f'{err}\n'.encode())
+            return
+
+        await _respond(writer, '200 OK')
+
+        loop = asyncio.get_running_loop()
+        words = iata_words.search(trie, *args, index=index)
+        while True:
+            lines = await loop.run_in_executor(None, _take, words, _format)
+            if not lines:
+                break
+            writer.write(('\n'.join(lines) + '\n').encode())
+            await writer.drain()
+    except (ConnectionResetError, BrokenPipeError):
+        logger.debug('client went away')
+    finally:
+        writer.close()
+
+
+async def _serve(handler, socket, port):
+    if socket:
+        server = await asyncio.start_unix_server(handler, path=socket)
+    else:
+        server = await asyncio.start_server(handler,
+                                            host='127.0.0.1', port=port)
+
+    logger.info('serving on %s',
+                ', '.join(str(x.getsockname()) for x in server.sockets))
+
+    async with server:
+        await server.serve_forever()
+
+
+@click.command()
+@click.option('--iata-codes',
+              help=''
+              'IATA codes list URL. Either file:// or couchdb(s):// ATM.',
+              required=True, metavar='<url>',
+              callback=iata_words._iata_codes_callback)  # pylint: disable=protected-access
+@iata_words.codes_cache_options
+@click.option('--tries',
+              help='wordlist tries path. Must be a serialized MARISA trie',
+              required=True, metavar='<path>')
+@click.option('--mmap',
+              help='memory-map the trie instead of loading it in memory',
+              is_flag=True, default=False)
+@click.option('--socket',
+              help='listen on this unix socket path',
+              metavar='<path>')
+@click.option('--port',
+              help='listen on this localhost port, when no --socket is given',
+              default=8053, show_default=True,
+              type=click.INT, metavar='<int>')
+def main(iata_codes, tries, mmap, socket, port):
+    '''
+    Serve find queries keeping trie and IATA codes loaded.
+    '''
+
+    trie = iata_words.load(tries, mmap)
+    index = iata_words.load_index(tries, mmap)
+    handler = functools.partial(_handle, trie, index, frozenset(iata_codes))
+
+    try:
+        asyncio.run(_serve(handler, socket, port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
@@ -6,35 +6,53 @@ Created on 25 feb 2019
 '''
 
 from collections import namedtuple
+from functools import lru_cache, partial
+import hashlib
+from itertools import islice
+import json
+import multiprocessing
+import os
 import sys
+import time
 from urllib.parse import urlparse
 
 import click
 import marisa_trie
 
+import instrument
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 IATA_CODE_LENGTH = 3
+WALK_SCAN_THRESHOLD = 1024
+INDEX_SUFFIX = '.iata'
+INDEX_CODE_MARK = '#'
+INDEX_LENGTH_MARK = ord('a')
+ALPHABET_SIZE = 26
+BITMAP_BATCH_SIZE = 4096
+WORKER_SHARDS = 16
+CODES_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'iata_words')
+CODES_TTL = 300
+OUTPUT_BATCH = 4096
 
+_WORKER = {}
 
-def find(iata_codes, tries, min_size=0, max_size=float('inf')):
-    '''
-    Return a 3-letter tuples generator of words consisting of
-    IATA codes.
 
-    :param iata_codes: a IATA codes iterable
-    :param tries: a MARISA trie file
-    :param min_size: word minimum size
-    :param max_size: word maximum size
+def _scan(trie, iata_codes, min_size, max_size):
     '''
+    Full key scan: check every trie word against the IATA codes set.
 
-    if not isinstance(iata_codes, set):
-        iata_codes = set(iata_codes)
-
-    trie = marisa_trie.Trie().load(tries)
+    Keys are iterated rather than listed: Trie.keys() builds the whole
+    list in one call, holding the GIL from any other thread meanwhile.
+    '''
 
     words = (word
              for word
-             in trie.keys()
+             in trie.iterkeys()
              if len(word) % 3 == 0
              and min_size <= len(word) <= max_size)
 
@@ -46,31 +64,546 @@ def find(iata_codes, tries, min_size=0, max_size=float('inf')):
             yield splitted
 
 
-def _iata_codes_callback(ctx, param, value):  # pylint: disable=unused-argument
+@lru_cache(maxsize=32)
+def _code_tree(iata_codes):
+    '''
+    Arrange IATA codes in a {first: {second: (third, ...)}} letters tree.
+    '''
 
-    iata_url = urlparse(value)
+    tree = {}
+    for code in sorted(iata_codes):
+        if len(code) == IATA_CODE_LENGTH:
+            tree.setdefault(code[0], {}).setdefault(code[1], []).append(code[2])
 
-    if iata_url.scheme == 'file':
-        iata_codes = set(x.strip()
-                         for x
-                         in open(iata_url.path).readlines())
-    elif iata_url.scheme.startswith('couchdb'):
-        try:
-            import cloudant
-        except ImportError:
-            print('Error: you must install cloudant module '
-                  'for couchdb urls to work')
-            sys.exit(1)
+    return {first: {second: tuple(thirds)
+                    for second, thirds in seconds.items()}
+            for first, seconds in tree.items()}
 
-        ConnInfo = namedtuple('ConnInfo', ('db', 'dd', 'vn'))
 
-        if iata_url.scheme.endswith('s'):
-            scheme = 'https'
-            port = iata_url.port if iata_url.port else 6984
-        else:
-            scheme = 'http'
-            port = iata_url.port if iata_url.port else 5984
+def _has_prefix(trie, prefix):
+    # Trie.has_keys_with_prefix() is deprecated
+    for _ in trie.iterkeys(prefix):
+        return True
+    return False
+
+
+def _descend(trie, iata_codes, code_tree,  # pylint: disable=too-many-arguments
+             min_size, max_size, root):
+    '''
+    Walk the trie below a (prefix, splitted prefix) root.
+    '''
+
+    has_prefix = partial(_has_prefix, trie)
+
+    stack = [root]
+    while stack:
+        prefix, splitted = stack.pop()
+        start = len(prefix)
+
+        if start + IATA_CODE_LENGTH > max_size:
+            continue
+
+        words = list(islice(trie.iterkeys(prefix), WALK_SCAN_THRESHOLD))
+        if len(words) < WALK_SCAN_THRESHOLD:
+            for word in words:
+                if (len(word) > start
+                        and len(word) % 3 == 0
+                        and min_size <= len(word) <= max_size):
+                    rest = tuple(word[i:i + IATA_CODE_LENGTH]
+                                 for i
+                                 in range(start, len(word), IATA_CODE_LENGTH))
+                    if iata_codes.issuperset(rest):
+                        yield splitted + rest
+            continue
+
+        for first, seconds in code_tree.items():
+            first_prefix = prefix + first
+            if not has_prefix(first_prefix):
+                continue
+            for second, thirds in seconds.items():
+                second_prefix = first_prefix + second
+                if not has_prefix(second_prefix):
+                    continue
+                for third in thirds:
+                    word = second_prefix + third
+                    if not has_prefix(word):
+                        continue
+                    codes = splitted + (word[start:], )
+                    if min_size <= len(word) and word in trie:
+                        yield codes
+                    stack.append((word, codes))
+
+
+def _walk(trie, iata_codes, min_size, max_size,  # pylint: disable=too-many-arguments
+          first_codes=None):
+    '''
+    Trie-guided search: descend the trie one letter at a time, following
+    only branches spelling a known IATA code, and drop a prefix as soon
+    as no trie word starts with it. Subtrees smaller than
+    WALK_SCAN_THRESHOLD words are cheaper to check word by word.
+
+    When first_codes is given, only words starting with one of them
+    are searched, in first_codes order.
+    '''
+
+    code_tree = _code_tree(frozenset(iata_codes))
+
+    if first_codes is None:
+        if '' in trie and min_size <= 0:
+            yield ()
+        yield from _descend(trie, iata_codes, code_tree,
+                            min_size, max_size, ('', ()))
+        return
+
+    for code in first_codes:
+        if (len(code) != IATA_CODE_LENGTH
+                or code not in iata_codes
+                or not _has_prefix(trie, code)):
+            continue
+        if min_size <= len(code) <= max_size and code in trie:
+            yield (code, )
+        yield from _descend(trie, iata_codes, code_tree,
+                            min_size, max_size, (code, (code, )))
+
+
+def _code_index(code):
+    '''
+    Map a A-Z 3-letter code to its 0 - 26^3 index.
+    '''
+
+    index = 0
+    for letter in code:
+        index = index * ALPHABET_SIZE + ord(letter) - ord('A')
+    return index
+
+
+@lru_cache(maxsize=32)
+def _bitmap(iata_codes):
+    '''
+    One flag per possible 3-letter code, set for IATA codes.
+    '''
+
+    bitmap = numpy.zeros(ALPHABET_SIZE ** IATA_CODE_LENGTH, dtype=bool)
+    bitmap[[_code_index(code)
+            for code
+            in iata_codes
+            if len(code) == IATA_CODE_LENGTH
+            and all('A' <= letter <= 'Z' for letter in code)]] = True
+
+    return bitmap
+
+
+def _check_batch(words, length, bitmap, iata_codes):
+    '''
+    Return the indices of same-length words consisting of IATA codes,
+    checking them all at once as arrays of code indices.
+
+    Words with letters out of A-Z have no place in the bitmap and are
+    checked one by one against the IATA codes set.
+    '''
+
+    letters = numpy.frombuffer(
+        ''.join(words).encode('ascii', 'replace'),
+        dtype=numpy.uint8).reshape(len(words), length) - ord('A')
+
+    # non A-Z letters wrap around to >= ALPHABET_SIZE
+    valid = (letters < ALPHABET_SIZE).all(axis=1)
+
+    letters = letters.astype(numpy.intp)
+    indices = (letters[:, 0::3] * ALPHABET_SIZE ** 2
+               + letters[:, 1::3] * ALPHABET_SIZE
+               + letters[:, 2::3])
+    numpy.minimum(indices, len(bitmap) - 1, out=indices)
+
+    matches = valid & bitmap[indices].all(axis=1)
+    for i in numpy.flatnonzero(~valid):
+        matches[i] = iata_codes.issuperset(
+            words[i][j:j + IATA_CODE_LENGTH]
+            for j
+            in range(0, length, IATA_CODE_LENGTH))
+
+    return numpy.flatnonzero(matches)
+
+
+def _bitmap_scan(trie, iata_codes, min_size, max_size):
+    '''
+    Full key scan, checking words in same-length batches against a
+    IATA codes bitmap.
+    '''
+
+    bitmap = _bitmap(frozenset(iata_codes))
+    batches = {}
+
+    def flush(length):
+        words = batches.pop(length)
+        for i in _check_batch(words, length, bitmap, iata_codes):
+            word = words[i]
+            yield tuple(word[j:j + IATA_CODE_LENGTH]
+                        for j
+                        in range(0, length, IATA_CODE_LENGTH))
+
+    for word in trie.iterkeys():
+        length = len(word)
+        if length % 3 != 0 or not min_size <= length <= max_size:
+            continue
+        if length == 0:
+            yield ()
+            continue
+        batch = batches.setdefault(length, [])
+        batch.append(word)
+        if len(batch) == BITMAP_BATCH_SIZE:
+            yield from flush(length)
+
+    for length in list(batches):
+        yield from flush(length)
+
+
+Index = namedtuple('Index', ('trie', 'iata_codes', 'lengths'))
+
+STRATEGIES = {
+    'walk': _walk,
+    'scan': _scan,
+}
+
+if numpy is not None:
+    STRATEGIES['bitmap'] = _bitmap_scan
+
+
+def load(tries, mmap=False):
+    '''
+    Load a serialized MARISA trie.
+
+    :param tries: a MARISA trie file
+    :param mmap: memory-map the file instead of reading it, so that
+                 concurrent processes share the same page-cache pages
+    '''
+
+    trie = marisa_trie.Trie()
+
+    return trie.mmap(tries) if mmap else trie.load(tries)
+
+
+def _index_key(word):
+    return chr(INDEX_LENGTH_MARK + len(word) // IATA_CODE_LENGTH) + word
+
+
+def build_index(trie, iata_codes):
+    '''
+    Return a MARISA trie holding the given IATA codes set and all the
+    words consisting of those codes, keyed by length in codes, then
+    by first code: a length mark letter followed by the word.
+
+    :param trie: a MARISA trie
+    :param iata_codes: a IATA codes iterable
+    '''
+
+    iata_codes = set(iata_codes)
+
+    keys = [INDEX_CODE_MARK + code for code in iata_codes]
+    keys.extend(_index_key(''.join(word))
+                for word
+                in _walk(trie, iata_codes, 0, float('inf')))
+
+    return marisa_trie.Trie(keys)
+
+
+def load_index(tries, mmap=False):
+    '''
+    Load the IATA words index built alongside a trie, if any and not
+    older than the trie itself.
+
+    :param tries: a MARISA trie file
+    :param mmap: memory-map the index file instead of reading it
+    '''
+
+    path = tries + INDEX_SUFFIX
+
+    if (not os.path.exists(path)
+            or os.path.getmtime(path) < os.path.getmtime(tries)):
+        return None
+
+    trie = load(path, mmap)
+
+    return Index(trie,
+                 frozenset(key[1:]
+                           for key
+                           in trie.iterkeys(INDEX_CODE_MARK)),
+                 tuple(length
+                       for length
+                       in range(0x100 - INDEX_LENGTH_MARK)
+                       if _has_prefix(trie, chr(INDEX_LENGTH_MARK + length))))
+
+
+def _lookup(index, iata_codes, min_size, max_size):
+    '''
+    Index lookup: words are already known to consist of index codes, so
+    they only need checking when asking for a codes subset, and then
+    only the words starting with one of those codes are looked at.
+    '''
+
+    lengths = [length
+               for length
+               in index.lengths
+               if min_size <= length * IATA_CODE_LENGTH <= max_size]
+
+    if lengths and lengths[0] == 0:
+        # the empty word, with no first code
+        yield ()
+        lengths.pop(0)
+
+    first_codes = ['']
+    subset = index.iata_codes != iata_codes
+    if subset:
+        first_codes = sorted(code
+                             for code
+                             in iata_codes
+                             if len(code) == IATA_CODE_LENGTH)
+
+    prefixes = [chr(INDEX_LENGTH_MARK + length) + code
+                for length in lengths
+                for code in first_codes]
+
+    for key in (key
+                for prefix in prefixes
+                for key in index.trie.iterkeys(prefix)):
+        splitted = tuple(key[i:i + IATA_CODE_LENGTH]
+                         for i
+                         in range(1, len(key), IATA_CODE_LENGTH))
+        if not subset or iata_codes.issuperset(splitted):
+            yield splitted
 
+
+def _covers(index, iata_codes):
+    return index is not None and index.iata_codes >= iata_codes
+
+
+def search(trie, iata_codes,  # pylint: disable=too-many-arguments
+           min_size=0, max_size=float('inf'), strategy='walk', index=None):
+    '''
+    Like find(), on an already loaded trie.
+
+    :param trie: a MARISA trie, may be None when index covers iata_codes
+    :param iata_codes: a IATA codes iterable
+    :param min_size: word minimum size
+    :param max_size: word maximum size
+    :param strategy: 'walk' (trie-guided search), 'scan' (full key scan)
+                     or, with numpy installed, 'bitmap' (full key scan in
+                     batches)
+    :param index: an IATA words index, used when its codes set
+                  includes iata_codes
+    '''
+
+    if not isinstance(iata_codes, (set, frozenset)):
+        iata_codes = set(iata_codes)
+
+    if _covers(index, iata_codes):
+        yield from _lookup(index, iata_codes, min_size, max_size)
+    else:
+        yield from STRATEGIES[strategy](trie, iata_codes, min_size, max_size)
+
+
+def _init_worker(tries, iata_codes,  # pylint: disable=too-many-arguments
+                 min_size, max_size, context):
+    _WORKER.update(trie=load(tries, mmap=True),
+                   iata_codes=iata_codes,
+                   min_size=min_size,
+                   max_size=max_size,
+                   context=context)
+
+
+def _search_shard(first_codes):
+    with instrument.worker(_WORKER['context']), \
+            instrument.stage('search') as stage:
+        words = list(_walk(_WORKER['trie'], _WORKER['iata_codes'],
+                           _WORKER['min_size'], _WORKER['max_size'],
+                           first_codes))
+        stage.add(shards=1, words=len(words))
+    return words
+
+
+def _parallel_search(tries, iata_codes,  # pylint: disable=too-many-arguments
+                     min_size, max_size, workers, ordered):
+    '''
+    Split the trie key space by first code into WORKER_SHARDS shards per
+    worker and walk them in a process pool, each process memory-mapping
+    the trie. Ordered results come shard by shard, i.e. by first code.
+    '''
+
+    if min_size <= 0 and '' in load(tries, mmap=True):
+        yield ()
+
+    first_codes = sorted(iata_codes)
+    if not first_codes:
+        return
+
+    size = -(-len(first_codes) // (workers * WORKER_SHARDS))
+    shards = [first_codes[i:i + size]
+              for i
+              in range(0, len(first_codes), size)]
+
+    with multiprocessing.Pool(workers, _init_worker,
+                              (tries, iata_codes, min_size, max_size,
+                               instrument.context())) as pool:
+        results = pool.imap if ordered else pool.imap_unordered
+        for words in results(_search_shard, shards):
+            yield from words
+
+
+def find(iata_codes, tries,  # pylint: disable=too-many-arguments
+         min_size=0, max_size=float('inf'), strategy='walk', mmap=False,
+         use_index=True, workers=1, ordered=True):
+    '''
+    Return a 3-letter tuples generator of words consisting of
+    IATA codes.
+
+    Words come out in no particular order, which may differ
+    between strategies.
+
+    :param iata_codes: a IATA codes iterable
+    :param tries: a MARISA trie file
+    :param min_size: word minimum size
+    :param max_size: word maximum size
+    :param strategy: 'walk' (trie-guided search), 'scan' (full key scan)
+                     or, with numpy installed, 'bitmap' (full key scan in
+                     batches)
+    :param mmap: memory-map the trie file instead of reading it
+    :param use_index: look words up in the trie IATA words index when
+                      there is one built for (a superset of) iata_codes
+    :param workers: walk the trie with this many processes, sharding
+                    it by first code; strategy and mmap are ignored
+    :param ordered: with workers, yield shards in first code order
+                    rather than as soon as they are done
+    '''
+
+    if not isinstance(iata_codes, (set, frozenset)):
+        iata_codes = set(iata_codes)
+
+    index = load_index(tries, mmap) if use_index else None
+
+    if workers > 1 and not _covers(index, iata_codes):
+        yield from _parallel_search(tries, iata_codes, min_size, max_size,
+                                    workers, ordered)
+        return
+
+    trie = None if _covers(index, iata_codes) else load(tries, mmap)
+
+    yield from search(trie, iata_codes, min_size, max_size, strategy, index)
+
+
+def _plain(words):
+    return ('\n'.join(map(''.join, words)) + '\n').encode()
+
+
+def _spaced(words):
+    return ('\n'.join(map(' '.join, words)) + '\n').encode()
+
+
+def _ndjson(words):
+    return ''.join(['["%s"]\n' % '","'.join(word) if word else '[]\n'
+                    for word in words]).encode()
+
+
+def _binary(words):
+    # chr(n) < 256 is the n byte in latin-1
+    return ''.join([chr(len(word)) + ''.join(word)
+                    for word in words]).encode('latin-1')
+
+
+OUTPUTS = {
+    'plain': _plain,
+    'spaced': _spaced,
+    'ndjson': _ndjson,
+    'binary': _binary,
+}
+
+
+def write(words, output, _format='plain'):
+    '''
+    Write words to a binary stream, encoded OUTPUT_BATCH at a time.
+
+    :param words: 3-letter tuples iterable, as find() yields
+    :param output: a binary file-like object
+    :param _format: one of OUTPUTS: 'plain' or 'spaced' lines, 'ndjson'
+                    arrays of codes, or 'binary' records made of a byte
+                    with the number of codes followed by the codes
+    '''
+
+    encode = OUTPUTS[_format]
+    stage = instrument.stage('output')
+
+    words = iter(words)
+    while True:
+        batch = list(islice(words, OUTPUT_BATCH))
+        if not batch:
+            break
+        data = encode(batch)
+        output.write(data)
+        stage.add(words=len(batch), bytes_out=len(data))
+
+
+def _codes_cache_path(cache_dir, iata_url, port):
+    '''
+    Cache file of a couchdb view URL, password left out.
+    '''
+
+    key = iata_url._replace(
+        netloc=f'{iata_url.username or ""}@{iata_url.hostname}:{port}',
+        query='', fragment='').geturl()
+    digest = hashlib.sha1(key.encode()).hexdigest()
+
+    return os.path.join(cache_dir, f'codes-{digest}.json')
+
+
+def _read_codes(path):
+    try:
+        with open(path) as data:
+            return json.load(data)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_codes(path, entry):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.{os.getpid()}.tmp', 'w') as output:
+        json.dump(entry, output)
+    os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+
+def _couchdb_codes(iata_url, cache_dir, ttl, offline):  # pylint: disable=too-many-locals
+    '''
+    IATA codes of a couchdb view, cached in cache_dir.
+
+    Cached codes younger than ttl seconds are used as they are, older
+    ones are revalidated: unchanged when the database update_seq is the
+    same, or else when the view ETag is; only then is the view fetched
+    again. Cached codes are also used, however old, when offline or when
+    couchdb cannot be reached.
+    '''
+
+    try:
+        import cloudant
+        import requests
+    except ImportError:
+        print('Error: you must install cloudant module '
+              'for couchdb urls to work')
+        sys.exit(1)
+
+    ConnInfo = namedtuple('ConnInfo', ('db', 'dd', 'vn'))
+
+    if iata_url.scheme.endswith('s'):
+        scheme = 'https'
+        port = iata_url.port if iata_url.port else 6984
+    else:
+        scheme = 'http'
+        port = iata_url.port if iata_url.port else 5984
+
+    path = _codes_cache_path(cache_dir, iata_url, port) if cache_dir else None
+    cached = _read_codes(path) if path else None
+
+    if cached and (offline or time.time() - cached['checked'] < ttl):
+        return set(cached['codes'])
+
+    try:
         client = cloudant.CouchDB(iata_url.username, iata_url.password,
                                   url=f'{scheme}://{iata_url.hostname}:{port}',
                                   connect=True)
@@ -84,17 +617,102 @@ def _iata_codes_callback(ctx, param, value):  # pylint: disable=unused-argument
         ddoc = cloudant.design_document.DesignDocument(database, conn_info.dd)
         view = cloudant.view.View(ddoc, conn_info.vn)
 
-        with view.custom_result(page_size=10000) as result:
-            iata_codes = set(x['key'] for x in result)
-            print(f'eia {len(iata_codes)}')
+        update_seq = etag = None
+        if path:
+            update_seq = database.metadata()['update_seq']
+            etag = cached['etag'] if cached else None
+            if not cached or cached['update_seq'] != update_seq:
+                response = client.r_session.get(
+                    view.url, params={'limit': 0},
+                    headers={'If-None-Match': etag} if etag else {})
+                response.raise_for_status()
+                etag = response.headers.get('ETag', etag)
+                if response.status_code != 304:
+                    cached = None
+
+        if cached:
+            iata_codes = set(cached['codes'])
+        else:
+            with view.custom_result(page_size=10000) as result:
+                iata_codes = set(x['key'] for x in result)
+                print(f'eia {len(iata_codes)}', file=sys.stderr)
+
+    except requests.RequestException as error:
+        if not cached:
+            raise
+        print(f'warning: {error}, using IATA codes cached '
+              f'{time.ctime(cached["checked"])}', file=sys.stderr)
+        return set(cached['codes'])
+
+    if path:
+        _write_codes(path, {'update_seq': update_seq,
+                            'etag': etag,
+                            'checked': time.time(),
+                            'codes': sorted(iata_codes)})
+
+    return iata_codes
+
+
+def _iata_codes_callback(ctx, param, value):  # pylint: disable=unused-argument
+
+    if value is None:
+        return None
+
+    iata_url = urlparse(value)
+
+    if iata_url.scheme == 'file':
+        iata_codes = set(x.strip()
+                         for x
+                         in open(iata_url.path).readlines())
+    elif iata_url.scheme.startswith('couchdb'):
+        iata_codes = _couchdb_codes(
+            iata_url,
+            ctx.meta.get('iata_words.codes_cache', CODES_CACHE),
+            ctx.meta.get('iata_words.codes_ttl', CODES_TTL),
+            ctx.meta.get('iata_words.offline', False))
 
     return iata_codes
 
 
+def _codes_cache_callback(ctx, param, value):
+    ctx.meta[f'iata_words.{param.name}'] = value
+
+
+def codes_cache_options(command):
+    '''
+    Add the --codes-cache, --codes-ttl and --offline options for a
+    --iata-codes couchdb URL to a click command.
+    '''
+
+    for option in reversed((
+            click.option('--codes-cache',
+                         help='directory caching IATA codes fetched from '
+                         'couchdb, empty to disable',
+                         default=CODES_CACHE, show_default=True,
+                         metavar='<path>', is_eager=True, expose_value=False,
+                         callback=_codes_cache_callback),
+            click.option('--codes-ttl',
+                         help='use cached IATA codes as they are for this '
+                         'many seconds, then revalidate them',
+                         default=CODES_TTL, show_default=True,
+                         type=click.FLOAT, metavar='<seconds>',
+                         is_eager=True, expose_value=False,
+                         callback=_codes_cache_callback),
+            click.option('--offline',
+                         help='use cached IATA codes without querying '
+                         'couchdb at all',
+                         is_flag=True, default=False,
+                         is_eager=True, expose_value=False,
+                         callback=_codes_cache_callback))):
+        command = option(command)
+
+    return command
+
+
 def _min_size_callback(ctx, param, value):  # pylint: disable=unused-argument
     if value % 3 != 0:
         value = value + 3 - value % 3
-        print(f'effective min_size will be {value}')
+        print(f'effective min_size will be {value}', file=sys.stderr)
 
     return value
 
@@ -102,7 +720,7 @@ def _min_size_callback(ctx, param, value):  # pylint: disable=unused-argument
 def _max_size_callback(ctx, param, value):  # pylint: disable=unused-argument
     if value != float('inf') and value % 3 != 0:
         value = value - value % 3
-        print(f'effective max_size will be {value}')
+        print(f'effective max_size will be {value}', file=sys.stderr)
 
     return value
 
@@ -127,19 +745,53 @@ def _max_size_callback(ctx, param, value):  # pylint: disable=unused-argument
               type=click.FLOAT, metavar='<int>',
               callback=_max_size_callback)
 @click.option('--format', '_format',
-              help="prints one word per line, either in plain or space-separated format",
-              type=click.Choice(['plain', 'spaced']),
+              help="prints one word per line, either in plain or space-separated format, "
+              "as NDJSON arrays of codes or as binary records: a byte with the number "
+              "of codes, then the codes",
+              type=click.Choice(list(OUTPUTS)),
               default='plain', show_default=True)
-def main(iata_codes, tries, min_size, max_size, _format):
+@click.option('--strategy',
+              help='search strategy: trie-guided walk, full key scan or, '
+              'with numpy installed, full key scan checked in batches against '
+              'a codes bitmap',
+              type=click.Choice(list(STRATEGIES)),
+              default='walk', show_default=True)
+@click.option('--mmap',
+              help='memory-map the trie instead of loading it in memory',
+              is_flag=True, default=False)
+@click.option('--index/--no-index', 'use_index',
+              help='use the IATA words index built alongside the trie, '
+              'if it matches the IATA codes',
+              default=True, show_default=True)
+@click.option('--workers',
+              help='walk the trie with this many processes',
+              default=1, show_default=True,
+              type=click.IntRange(min=1), metavar='<int>')
+@click.option('--ordered/--unordered',
+              help='with --workers, print results in first code order '
+              'or as soon as they are found',
+              default=True, show_default=True)
+@codes_cache_options
+@instrument.options
+def main(iata_codes, tries, min_size, max_size,  # pylint: disable=too-many-arguments
+         _format, strategy, mmap, use_index, workers, ordered,
+         progress, report, profile):
     '''
     Find a set of words consisting of IATA codes.
     '''
 
-    for word in find(iata_codes, tries, min_size, max_size):
-        if _format == 'plain':
-            print(f'{"".join(word)}')
-        elif _format == 'spaced':
-            print(f'{" ".join(word)}')
+    with instrument.Session('iata_words', progress, report, profile):
+        sys.stdout.flush()
+        try:
+            write(find(iata_codes, tries, min_size, max_size,
+                       strategy, mmap, use_index, workers, ordered),
+                  sys.stdout.buffer, _format)
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # reader gone, e.g. head: keep the interpreter from failing
+            # to flush stdout again on exit
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            sys.exit(1)
 
 
 if __name__ == '__main__':
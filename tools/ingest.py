@@ -4,27 +4,61 @@ Created on 26 feb 2019
 
 @author: Alessandro Ogier <alessandro.ogier@gmail.com>
 '''
-import cProfile
+import asyncio
+import base64
+from collections import namedtuple
+import contextlib
+import hashlib
+import itertools
+import json
 import multiprocessing
 import os
+import queue
+import sqlite3
 import sys
+import time
+from urllib.parse import quote
 
 import click
 import cloudant
-import ijson
+
+try:
+    # the C backend, else whichever one ijson picks
+    import ijson.backends.yajl2_c as ijson
+except ImportError:
+    import ijson
+
+import instrument
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
 
 STOP = 'KTHXBYE'
+CACHE_QUERY_SIZE = 500
+CHECKPOINT_INTERVAL = 10
+CHECKPOINT_DRAIN = 1000
+BATCH_SIZE = 100
+MIN_BATCH_SIZE = 10
+MAX_BATCH_SIZE = 2000
+BATCH_LATENCY = 0.25
+NDJSON_BATCH = 1000
+NDJSON_SKIP_SIZE = 2**24
 
 
-def _worker(in_queue, database, when_existing):
+def _diff(items, existing, when_existing):
+    '''
+    Documents to write for a batch of items, given the existing ones
+    by _id.
+    '''
 
     batch = []
-    for item in iter(in_queue.get, STOP):
+    for item in items:
 
-        try:
-            doc = database[item['_id']]
-        except KeyError:
+        doc = existing.get(item['_id'])
+        if doc is None:
             batch.append(item)
             continue
 
@@ -33,28 +67,779 @@ def _worker(in_queue, database, when_existing):
 
         if when_existing == 'overwrite':
             print(f'overwriting {item}')
-            doc.delete()
-            doc.update(item)
+            batch.append(dict(item, _rev=doc['_rev']))
         elif when_existing == 'update':
             print(f'updating {item}')
-            doc.update(item)
+            batch.append(dict(doc, **item))
         elif when_existing == 'ignore':
             #             print(f'ignoring {item}')
             continue
 
-        batch.append(doc)
+    return batch
+
+
+def _existing(result):
+    return {row['key']: row['doc']
+            for row in result['rows']
+            if row.get('doc')}
+
+
+def _digest(item):
+    return hashlib.blake2b(json.dumps(item, sort_keys=True,
+                                      separators=(',', ':'),
+                                      default=str).encode(),
+                           digest_size=16).hexdigest()
+
+
+class _Cache:
+    '''
+    _id -> (content digest, _rev) of items as of their last successful
+    ingest, in a sqlite database safe to share among workers.
+
+    An item whose digest matches is known to be in the database already
+    and is skipped with no network I/O at all.
+
+    A cache belongs to the database, couchdb url and name, it was first
+    filled for: opening it for another one is a usage error, but to
+    rebuild() it.
+    '''
+
+    def __init__(self, path, dburl=None):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS docs '
+                                '(id TEXT PRIMARY KEY, '
+                                'digest TEXT NOT NULL, '
+                                'rev TEXT NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta '
+                                '(key TEXT PRIMARY KEY, '
+                                'value TEXT NOT NULL)')
+        self.skipped = 0
+
+        if dburl is not None:
+            self._claim(dburl)
+
+    def _claim(self, dburl):
+        '''
+        Make an empty cache dburl's, check a filled one is.
+        '''
+
+        with self.connection:
+            if self.connection.execute(
+                    'SELECT NOT EXISTS (SELECT 1 FROM docs)').fetchone()[0]:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                    ('database', dburl))
+
+        owner = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'database'").fetchone()
+        if owner is None or owner[0] != dburl:
+            raise click.UsageError(
+                f'cache {self.path} is for '
+                f'{owner[0] if owner else "an unknown database"}, not '
+                f'{dburl}: use another one or --rebuild-cache')
+
+    def changed(self, items):
+        '''
+        Items not matching their cached digest, and all items digests
+        by _id.
+        '''
+
+        digests = {item['_id']: _digest(item) for item in items}
+        ids = list(digests)
+
+        cached = {}
+        for i in range(0, len(ids), CACHE_QUERY_SIZE):
+            chunk = ids[i:i + CACHE_QUERY_SIZE]
+            cached.update(self.connection.execute(
+                'SELECT id, digest FROM docs WHERE id IN (%s)'
+                % ','.join('?' * len(chunk)), chunk))
+
+        changed = [item for item in items
+                   if cached.get(item['_id']) != digests[item['_id']]]
+        self.skipped += len(items) - len(changed)
+        instrument.stage('write').add(skipped=len(items) - len(changed))
+
+        return changed, digests
+
+    def store(self, entries):
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO docs VALUES (?, ?, ?)', entries)
+
+    def verify(self, database):
+        '''
+        Drop entries whose _rev is not the current one in database.
+        '''
+
+        cached = dict(self.connection.execute('SELECT id, rev FROM docs'))
+        stale = []
+
+        with database.custom_result(page_size=10000) as result:
+            for row in result:
+                rev = cached.pop(row['id'], None)
+                if rev is not None and rev != row['value']['rev']:
+                    stale.append(row['id'])
+
+        stale.extend(cached)
+
+        with self.connection:
+            self.connection.executemany('DELETE FROM docs WHERE id = ?',
+                                        ((x,) for x in stale))
+
+        return stale
+
+    def rebuild(self, database, dburl):
+        '''
+        Refill from database contents, taking each document without its
+        _rev as the item that was ingested; the cache is dburl's from now
+        on.
+        '''
+
+        with self.connection:
+            self.connection.execute('DELETE FROM docs')
+            self.connection.execute(
+                'INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                ('database', dburl))
+
+        count = 0
+        with database.custom_result(include_docs=True,
+                                    page_size=10000) as result:
+            for rows in _chunks(result, CACHE_QUERY_SIZE):
+                self.store(
+                    (row['id'],
+                     _digest({k: v for k, v in row['doc'].items()
+                              if k != '_rev'}),
+                     row['doc']['_rev'])
+                    for row in rows)
+                count += len(rows)
+
+        return count
+
+
+def _chunks(iterable, size):
+    iterable = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterable, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _settled(items, existing, written, digests):
+    '''
+    Cache entries for the items now in the database: unchanged ones at
+    their current _rev, written ones at the new one.
+    '''
+
+    revs = {row['id']: row['rev']
+            for row in written
+            if 'error' not in row}
+
+    for item in items:
+        doc = existing.get(item['_id'])
+        if doc is not None and item.items() <= doc.items():
+            revs.setdefault(item['_id'], doc['_rev'])
+
+    return [(docid, digests[docid], rev)
+            for docid, rev in revs.items()
+            if docid in digests]
+
+
+def _failed(items, written):
+    errors = {row['id']: row for row in written if 'error' in row}
+    return [(item, errors[item['_id']])
+            for item in items
+            if item['_id'] in errors]
+
+
+def _write_batch(database, items, when_existing, cache=None):
+    '''
+    Fetch existing documents for a batch of items at once, then bulk
+    write new and changed ones.
+
+    Return the items that went past the cache, how many docs bulk_docs
+    wrote, and the items it refused with the error rows.
+    '''
+
+    if cache is not None:
+        items, digests = cache.changed(items)
+        if not items:
+            return [], 0, []
+
+    result = database.all_docs(keys=[item['_id'] for item in items],
+                               include_docs=True)
+    existing = _existing(result)
+    batch = _diff(items, existing, when_existing)
+    # unchanged, or changed and ignored
+    instrument.stage('write').add(dropped=len(items) - len(batch))
+
+    written = database.bulk_docs(batch) if batch else []
+
+    if cache is not None:
+        cache.store(_settled(items, existing, written, digests))
+
+    failed = _failed(items, written)
+    return items, len(batch) - len(failed), failed
+
+
+class _Batcher:
+    '''
+    Accumulate items into batches, ready on whichever comes first of the
+    docs limit, max_bytes of JSON or linger seconds since the first item.
+
+    The docs limit follows observed write latency: it doubles while
+    batches that hit it come back within half BATCH_LATENCY and halves
+    when they take longer than BATCH_LATENCY.
+    '''
+
+    def __init__(self, max_bytes, linger):
+        self.max_bytes = max_bytes
+        self.linger = linger
+        self.size = BATCH_SIZE
+        self.items = []
+        self.positions = []
+        self.bytes = 0
+        self.first = None
+        self.started = time.monotonic()
+        self.read = 0
+        self.batches = []
+
+    def add(self, item, position=None):
+        if not self.items:
+            self.first = time.monotonic()
+        self.items.append(item)
+        self.positions.append(position)
+        self.bytes += len(json.dumps(item, default=str))
+
+    def timeout(self):
+        '''
+        Seconds left before the current batch has lingered enough, None
+        when there is none.
+        '''
+
+        if not self.items:
+            return None
+        return max(self.first + self.linger - time.monotonic(), 0)
+
+    def ready(self):
+        return (len(self.items) >= self.size
+                or self.bytes >= self.max_bytes
+                or self.timeout() == 0)
+
+    def take(self):
+        batch = self.items, self.bytes, self.positions
+        self.items, self.bytes, self.positions = [], 0, []
+        return batch
+
+    def record(self, items, sent, written, nbytes, elapsed):  # pylint: disable=too-many-arguments
+        '''
+        Account for a batch of items, sent being the ones that made it
+        to the database, written the number of docs bulk_docs actually
+        wrote: a batch the cache skipped as a whole made no request at
+        all and is not a batch.
+        '''
+
+        self.read += len(items)
+        if not sent:
+            return
+
+        docs = len(sent)
+        if docs < len(items):
+            nbytes = sum(len(json.dumps(item, default=str))
+                         for item in sent)
+
+        self.batches.append((docs, written, nbytes, elapsed))
+
+        stage = instrument.stage('write')
+        stage.add(docs=docs, written=written, batches=1, bytes_out=nbytes)
+        stage.peak(batch_docs=docs, latency_ms=elapsed * 1000)
+
+        if elapsed < BATCH_LATENCY / 2:
+            if docs >= self.size:
+                self.size = min(self.size * 2, MAX_BATCH_SIZE)
+        elif elapsed > BATCH_LATENCY:
+            self.size = max(min(self.size, docs) // 2, MIN_BATCH_SIZE)
+
+    def report(self, name):
+        elapsed = time.monotonic() - self.started
+        if not self.batches:
+            print(f'{name}: {self.read} items, nothing written in '
+                  f'{elapsed:.1f}s')
+            return
+
+        docs, written, nbytes, latency = (list(x) for x in zip(*self.batches))
+        count = len(self.batches)
+        print(f'{name}: {self.read} items, {sum(docs)} docs checked, '
+              f'{sum(written)} written, {sum(nbytes) / 2**20:.1f} MiB '
+              f'in {count} batches, {elapsed:.1f}s, '
+              f'{sum(written) / elapsed:.0f} docs/s written; '
+              f'batch docs min/avg/max {min(docs)}/{sum(docs) / count:.0f}'
+              f'/{max(docs)}, avg {sum(nbytes) / count / 1024:.1f} KiB, '
+              f'avg latency {sum(latency) / count * 1000:.1f} ms, '
+              f'final docs limit {self.size}')
+
+
+Options = namedtuple('Options', ('when_existing', 'max_bytes', 'linger',
+                                 'cache_path', 'retry_path', 'dburl'))
+
+
+def _cache(options):
+    return _Cache(options.cache_path, options.dburl) \
+        if options.cache_path else None
+
+
+def _retry(path, failed):
+    '''
+    Report failed items and append them to the path NDJSON file, if any,
+    for a later run to retry.
+    '''
+
+    instrument.stage('write').add(failed=len(failed))
+
+    for item, row in failed:
+        print(f'failed {item["_id"]}: {row["error"]} {row.get("reason")}')
+
+    if path and failed:
+        with open(path, 'a') as retry:
+            retry.write(''.join(json.dumps(item, default=str) + '\n'
+                                for item, _ in failed))
+
+
+def _flusher(batcher, database, options, cache, done):
+
+    def flush():
+        items, nbytes, positions = batcher.take()
+        start = time.monotonic()
+        sent, written, failed = _write_batch(database, items,
+                                             options.when_existing, cache)
+        batcher.record(items, sent, written, nbytes,
+                       time.monotonic() - start)
+        _retry(options.retry_path, failed)
+        if done is not None:
+            done(positions)
+
+    return flush
+
+
+def _report(name, batcher, cache):
+    batcher.report(name)
+    if cache is not None:
+        print(f'{name}: {cache.skipped} unchanged docs skipped by cache')
+
+
+def _peak(**queues):
+    '''
+    Sample the depth of queues, where the platform tells.
+    '''
+
+    with contextlib.suppress(NotImplementedError):
+        instrument.stage('write').peak(**{name: x.qsize()
+                                          for name, x in queues.items()
+                                          if x is not None})
+
+
+def _worker(in_queue, done_queue, database, options):
+    '''
+    Write (seq, offset, item) entries from in_queue, reporting positions
+    of the written ones to done_queue when there is one.
+    '''
+
+    batcher = _Batcher(options.max_bytes, options.linger)
+    cache = _cache(options)
+    flush = _flusher(batcher, database, options, cache,
+                     None if done_queue is None
+                     else lambda positions: done_queue.put((0, positions)))
+
+    while True:
+        try:
+            entry = in_queue.get(timeout=batcher.timeout())
+        except queue.Empty:
+            flush()
+            continue
+
+        if entry == STOP:
+            break
+
+        seq, offset, item = entry
+        batcher.add(item, (seq, offset))
+
+        if batcher.ready():
+            flush()
+            _peak(in_queue=in_queue, done_queue=done_queue)
+
+    if batcher.items:
+        flush()
+
+    _report(f'worker {os.getpid()}', batcher, cache)
+
+
+def _range_worker(path, index, bounds, id_field,  # pylint: disable=too-many-arguments
+                  done_queue, database, options):
+    '''
+    Parse and write the NDJSON lines of the index-th range of path by
+    itself, no queue involved. bounds are [start, end, offset, count],
+    offset and count being where to resume from.
+    '''
 
-        if len(batch) > 100:
-            database.bulk_docs(batch)
-            batch = []
+    _, end, offset, count = bounds
 
+    batcher = _Batcher(options.max_bytes, options.linger)
+    cache = _cache(options)
+    flush = _flusher(batcher, database, options, cache,
+                     None if done_queue is None
+                     else lambda positions: done_queue.put((index,
+                                                            positions)))
+
+    entries = _items(_ndjson(_lines(path, offset, end), offset), id_field)
+    for seq, (position, item) in enumerate(entries, count):
+
+        batcher.add(item, (seq, position))
+
+        if batcher.ready():
+            flush()
+            _peak(done_queue=done_queue)
+
+    if batcher.items:
+        flush()
+
+    _report(f'worker {os.getpid()} [{offset}, {end})', batcher, cache)
+
+
+async def _async_write_batch(session, dburl, items, when_existing,
+                             cache=None):
+    '''
+    Same as _write_batch, over an aiohttp session.
+    '''
+
+    if cache is not None:
+        items, digests = cache.changed(items)
+        if not items:
+            return [], 0, []
+
+    async with session.post(f'{dburl}/_all_docs',
+                            params={'include_docs': 'true'},
+                            json={'keys': [item['_id']
+                                           for item in items]}) as response:
+        response.raise_for_status()
+        result = await response.json()
+
+    existing = _existing(result)
+    batch = _diff(items, existing, when_existing)
+    # unchanged, or changed and ignored
+    instrument.stage('write').add(dropped=len(items) - len(batch))
+
+    written = []
     if batch:
-        database.bulk_docs(batch)
+        async with session.post(f'{dburl}/_bulk_docs',
+                                json={'docs': batch}) as response:
+            response.raise_for_status()
+            written = await response.json()
+
+    if cache is not None:
+        cache.store(_settled(items, existing, written, digests))
 
+    failed = _failed(items, written)
+    return items, len(batch) - len(failed), failed
 
-def _profi_worker(in_queue, database, when_existing):  # pylint: disable=unused-argument
-    cProfile.runctx('_worker(in_queue, database, when_existing)',
-                    globals(), locals(), 'prof%d.prof' % os.getpid())
+
+async def _async_ingest(entries, url, auth, dbname,  # pylint: disable=too-many-arguments
+                        create_database, concurrency, options, checkpoint):
+    '''
+    Write (seq, offset, item) entries keeping up to concurrency batches
+    in flight over a single pooled session, batched by a _Batcher.
+
+    Input is parsed synchronously, so linger is only checked as items
+    come in.
+    '''
+
+    dburl = f'{url}/{quote(dbname, safe="")}'
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(
+            headers={'Authorization': auth},
+            connector=connector) as session:
+
+        if create_database:
+            async with session.put(dburl) as response:
+                if response.status != 412:
+                    response.raise_for_status()
+        else:
+            async with session.head(dburl) as response:
+                if response.status == 404:
+                    print(f'database {dbname} not found')
+                    sys.exit(1)
+                response.raise_for_status()
+
+        slots = asyncio.Semaphore(concurrency)
+        pending = set()
+        batcher = _Batcher(options.max_bytes, options.linger)
+        cache = _cache(options)
+
+        async def write(batch, nbytes, positions):
+            start = time.monotonic()
+            try:
+                sent, written, failed = await _async_write_batch(
+                    session, dburl, batch, options.when_existing, cache)
+            finally:
+                slots.release()
+            batcher.record(batch, sent, written, nbytes,
+                           time.monotonic() - start)
+            _retry(options.retry_path, failed)
+            if checkpoint is not None:
+                checkpoint.complete(0, positions)
+
+        async def submit():
+            await slots.acquire()
+            for task in [x for x in pending if x.done()]:
+                pending.remove(task)
+                task.result()
+            pending.add(asyncio.ensure_future(write(*batcher.take())))
+            await asyncio.sleep(0)
+
+        for seq, offset, item in entries:
+            batcher.add(item, (seq, offset))
+            if batcher.ready():
+                await submit()
+
+        if batcher.items:
+            await submit()
+
+        await asyncio.gather(*pending)
+
+    _report('ingest', batcher, cache)
+
+
+def _basic_auth(user, password):
+    credentials = base64.b64encode(f'{user}:{password}'.encode()).decode()
+    return f'Basic {credentials}'
+
+
+class _Checkpoint:
+    '''
+    For each input range, the input offset and items count up to which
+    everything went through bulk_docs, saved to path as JSON at most
+    every CHECKPOINT_INTERVAL seconds.
+
+    Ranges are [start, end, offset, count] lists; a whole stream is a
+    single [0, None, offset, count] range, offset being None for JSON
+    arrays that can only be resumed by count.
+    '''
+
+    def __init__(self, path, source, ranges):
+        self.path = path
+        self.source = source
+        self.ranges = ranges
+        self.done = [{} for _ in ranges]
+        self.saved = time.monotonic()
+
+    @classmethod
+    def load(cls, path, source):
+        with open(path) as data:
+            state = json.load(data)
+
+        changed = sorted(key
+                         for key in source.keys() | state['source'].keys()
+                         if state['source'].get(key) != source.get(key))
+        if changed:
+            raise click.UsageError(f'checkpoint {path} does not match this '
+                                   f'run, {", ".join(changed)} changed: '
+                                   'remove it to start over')
+
+        return cls(path, source, state['ranges'])
+
+    def complete(self, index, positions):
+        '''
+        Mark (seq, offset) positions of a range done, moving its offset
+        and count past every consecutive done one.
+        '''
+
+        bounds = self.ranges[index]
+        done = self.done[index]
+        done.update(positions)
+
+        while bounds[3] in done:
+            offset = done.pop(bounds[3])
+            if offset is not None:
+                bounds[2] = offset
+            bounds[3] += 1
+
+        if time.monotonic() - self.saved >= CHECKPOINT_INTERVAL:
+            self.save()
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as output:
+            json.dump({'source': self.source, 'ranges': self.ranges}, output)
+        os.replace(self.path + '.tmp', self.path)
+        self.saved = time.monotonic()
+
+    def count(self):
+        return sum(x[3] for x in self.ranges)
+
+
+def _entries(stream, input_format, single, id_field, bounds):
+    '''
+    (seq, offset, item) entries of a whole stream, resuming from bounds
+    offset for NDJSON, skipping bounds count items for JSON.
+    '''
+
+    _, _, offset, count = bounds
+
+    if input_format == 'ndjson':
+        if stream.seekable():
+            stream.seek(offset)
+        else:
+            for _ in range(offset // NDJSON_SKIP_SIZE):
+                stream.read(NDJSON_SKIP_SIZE)
+            stream.read(offset % NDJSON_SKIP_SIZE)
+        items = _items(_ndjson(stream, offset), id_field)
+    else:
+        items = itertools.islice(
+            _items(_parse(stream, input_format, single), id_field),
+            count, None)
+
+    for seq, (position, item) in enumerate(items, count):
+        yield seq, position, item
+
+
+def _drain(done_queue, checkpoint, timeout=None):
+    '''
+    Feed checkpoint with what workers reported done so far, waiting up
+    to timeout for the first report.
+    '''
+
+    try:
+        message = done_queue.get(timeout is not None, timeout)
+        while True:
+            checkpoint.complete(*message)
+            message = done_queue.get_nowait()
+    except queue.Empty:
+        pass
+
+
+def _put(in_queue, entry, gone):
+    '''
+    Put entry in in_queue, giving up and returning False as soon as the
+    gone() workers are not going to get it.
+    '''
+
+    while True:
+        try:
+            in_queue.put(entry, timeout=1)
+            return True
+        except queue.Full:
+            if gone():
+                return False
+
+
+def _close(checkpoint, done):
+    '''
+    Drop the checkpoint of a completed run, save it otherwise.
+    '''
+
+    if checkpoint is None:
+        return
+
+    if done:
+        if os.path.exists(checkpoint.path):
+            os.remove(checkpoint.path)
+    else:
+        checkpoint.save()
+        print(f'checkpoint saved after {checkpoint.count()} items')
+
+
+def _ranges(path, count):
+    '''
+    Split path in up to count byte ranges, each ending on a newline.
+    '''
+
+    size = os.path.getsize(path)
+    bounds = [0]
+
+    with open(path, 'rb') as data:
+        for i in range(1, count):
+            if size * i // count <= bounds[-1]:
+                continue
+            data.seek(size * i // count)
+            data.readline()
+            if data.tell() >= size:
+                break
+            bounds.append(data.tell())
+
+    bounds.append(size)
+
+    return list(zip(bounds, bounds[1:]))
+
+
+def _lines(path, start, end):
+    with open(path, 'rb') as data:
+        data.seek(start)
+        while start < end:
+            line = data.readline()
+            if not line:
+                break
+            start += len(line)
+            yield line
+
+
+def _ndjson(lines, offset=0):
+    '''
+    (offset past its line, document) pairs out of lines starting at
+    offset.
+
+    NDJSON_BATCH lines are parsed at a time as a single JSON array, way
+    faster than one json.loads() per line.
+    '''
+
+    batch, ends = [], []
+    for line in lines:
+        offset += len(line)
+        if not line.strip():
+            continue
+
+        batch.append(line)
+        ends.append(offset)
+
+        if len(batch) == NDJSON_BATCH:
+            yield from zip(ends, json.loads(b'[' + b','.join(batch) + b']'))
+            batch, ends = [], []
+
+    if batch:
+        yield from zip(ends, json.loads(b'[' + b','.join(batch) + b']'))
+
+
+def _parse(stream, input_format, single):
+    '''
+    (offset, item) pairs from a binary stream, either one JSON document
+    per line or a JSON array (a single object with single) parsed
+    incrementally, with no offsets.
+    '''
+
+    if input_format == 'ndjson':
+        return _ndjson(stream)
+
+    return ((None, item)
+            for item
+            in ijson.items(stream, '' if single else 'item', use_float=True))
+
+
+def _items(entries, id_field):
+    stage = instrument.stage('parse')
+
+    for offset, item in entries:
+
+        if id_field:
+            if not item[id_field]:
+                print(f'skipping null id: {item}')
+                stage.add(skipped=1)
+                continue
+            else:
+                item['_id'] = item[id_field]
+
+        stage.add(items=1)
+        yield offset, item
 
 
 @click.command(help='Ingest data into a db')
@@ -77,16 +862,64 @@ def _profi_worker(in_queue, database, when_existing):  # pylint: disable=unused-
 @click.option('--pool-size',
               help='pool size',
               default=2)
+@click.option('--engine',
+              help='processes pool or a single asyncio process',
+              type=click.Choice(['processes', 'asyncio']),
+              default='processes', show_default=True)
+@click.option('--concurrency',
+              help='concurrent requests in flight, asyncio engine only',
+              default=8, show_default=True, type=click.IntRange(min=1))
+@click.option('--batch-bytes',
+              help='flush batches reaching this JSON size, in bytes',
+              default=2**20, show_default=True, type=click.IntRange(min=1))
+@click.option('--batch-linger',
+              help='flush batches older than this, in seconds',
+              default=1.0, show_default=True, type=click.FLOAT)
+@click.option('--input', 'path',
+              help='input file, - for stdin',
+              default='-', show_default=True,
+              type=click.Path(allow_dash=True, dir_okay=False))
+@click.option('--input-format',
+              help=''
+              'a JSON array or one JSON document per line. NDJSON files '
+              'are split among processes workers, each parsing its share',
+              type=click.Choice(['json', 'ndjson']),
+              default='json', show_default=True)
 @click.option('--single',
               help='input is a single object, ie. not an array',
               is_flag=True, default=False)
-@click.option('--profile',
-              help='profile process (debug only',
+@click.option('--cache', 'cache_path',
+              help=''
+              'local cache of ingested documents digests; unchanged ones '
+              'are skipped without querying the db',
+              type=click.Path(dir_okay=False), metavar='<path>')
+@click.option('--verify-cache',
+              help='drop cache entries out of date with the db, then exit',
+              is_flag=True, default=False)
+@click.option('--rebuild-cache',
+              help='rebuild the cache from db contents, then exit',
               is_flag=True, default=False)
+@click.option('--checkpoint', 'checkpoint_path',
+              help=''
+              'periodically save here how far input went through the db, '
+              'removed once done',
+              type=click.Path(dir_okay=False), metavar='<path>')
+@click.option('--resume',
+              help='resume from --checkpoint, when there is one, if input '
+              'file, options and db are the same; not from stdin',
+              is_flag=True, default=False)
+@click.option('--retry-file', 'retry_path',
+              help='append documents the db refused here, as NDJSON',
+              type=click.Path(dir_okay=False), metavar='<path>')
+@instrument.options
 def main(couchdb_user, couchdb_pass, couchdb_url,  # pylint: disable=too-many-arguments, too-many-locals
          dbname, create_database,
          id_field, when_existing,
-         pool_size, single, profile):
+         pool_size, engine, concurrency, batch_bytes, batch_linger,
+         path, input_format, single,
+         cache_path, verify_cache, rebuild_cache,
+         checkpoint_path, resume, retry_path,
+         progress, report, profile):
     '''
     Ingest data into a db
 
@@ -98,50 +931,188 @@ def main(couchdb_user, couchdb_pass, couchdb_url,  # pylint: disable=too-many-ar
     :param id_field:
     :param when_existing:
     :param pool_size:
+    :param engine:
+    :param concurrency:
+    :param batch_bytes:
+    :param batch_linger:
+    :param path:
+    :param input_format:
     :param single:
+    :param cache_path:
+    :param verify_cache:
+    :param rebuild_cache:
+    :param checkpoint_path:
+    :param resume:
+    :param retry_path:
+    :param progress:
+    :param report:
     :param profile:
     '''
 
-    process_queue = multiprocessing.Queue(50)
+    with instrument.Session('ingest', progress, report, profile):
+        dburl = f'{couchdb_url.rstrip("/")}/{quote(dbname, safe="")}'
 
-    process_pool = []
-    for _ in range(pool_size):
-        client = cloudant.CouchDB(couchdb_user, couchdb_pass,
-                                  url=couchdb_url,
-                                  connect=True)
+        if verify_cache or rebuild_cache:
+            if not cache_path:
+                raise click.UsageError(
+                    '--verify-cache and --rebuild-cache require --cache')
 
-        if create_database:
-            database = client.create_database(dbname)
-        else:
+            client = cloudant.CouchDB(couchdb_user, couchdb_pass,
+                                      url=couchdb_url,
+                                      connect=True)
             try:
                 database = client[dbname]
             except KeyError:
                 print(f'database {dbname} not found')
                 sys.exit(1)
 
-        process = multiprocessing.Process(
-            target=_profi_worker if profile else _worker,
-            args=(process_queue, database, when_existing))
+            if rebuild_cache:
+                cache = _Cache(cache_path)
+                print(f'cache rebuilt, {cache.rebuild(database, dburl)} '
+                      'entries')
+            else:
+                cache = _Cache(cache_path, dburl)
+                print(f'cache verified, {len(cache.verify(database))} '
+                      'stale entries dropped')
+            return
 
-        process.start()
-        process_pool.append(process)
+        if resume and not checkpoint_path:
+            raise click.UsageError('--resume requires --checkpoint')
+        if resume and path == '-':
+            raise click.UsageError('--resume cannot resume standard input')
 
-    for item in ijson.items(sys.stdin, '' if single else 'item'):
+        options = Options(when_existing, batch_bytes, batch_linger,
+                          cache_path, retry_path, dburl)
 
-        if id_field:
-            if not item[id_field]:
-                print(f'skipping null id: {item}')
-                continue
+        if cache_path:
+            # claimed, or refused, before any worker opens it
+            _cache(options)
+
+        split = (engine == 'processes'
+                 and input_format == 'ndjson' and path != '-')
+
+        source = {'input': path, 'format': input_format, 'single': single,
+                  'id_field': id_field, 'split': split, 'database': dburl}
+        if path != '-':
+            # offsets and counts only hold for the very same contents
+            stat = os.stat(path)
+            source.update(size=stat.st_size, mtime=stat.st_mtime_ns)
+
+        checkpoint = None
+        if resume and os.path.exists(checkpoint_path):
+            checkpoint = _Checkpoint.load(checkpoint_path, source)
+            ranges = checkpoint.ranges
+            print(f'resuming after {checkpoint.count()} items')
+        else:
+            if resume:
+                print(f'no checkpoint at {checkpoint_path}, starting over')
+            if split:
+                ranges = [[start, end, start, 0]
+                          for start, end in _ranges(path, pool_size)]
             else:
-                item['_id'] = item[id_field]
+                ranges = [[0, None, 0, 0]]
+            if checkpoint_path:
+                checkpoint = _Checkpoint(checkpoint_path, source, ranges)
+
+        stream = click.open_file(path, 'rb') if not split else None
+
+        if engine == 'asyncio':
+            if aiohttp is None:
+                print('Error: you must install aiohttp module '
+                      'for the asyncio engine to work')
+                sys.exit(1)
+
+            ingest = _async_ingest(_entries(stream, input_format, single,
+                                            id_field, ranges[0]),
+                                   couchdb_url,
+                                   _basic_auth(couchdb_user, couchdb_pass),
+                                   dbname, create_database, concurrency,
+                                   options, checkpoint)
+            done = False
+            try:
+                asyncio.run(ingest)
+                done = True
+            finally:
+                _close(checkpoint, done)
+            return
+
+        done_queue = multiprocessing.Queue() if checkpoint else None
+
+        if split:
+            workers = [(index, bounds)
+                       for index, bounds in enumerate(ranges)
+                       if bounds[2] < bounds[1]]
+        else:
+            process_queue = multiprocessing.Queue(50)
+            workers = [(0, None)] * pool_size
+
+        process_pool = []
+        for index, bounds in workers:
+            client = cloudant.CouchDB(couchdb_user, couchdb_pass,
+                                      url=couchdb_url,
+                                      connect=True)
+
+            if create_database:
+                database = client.create_database(dbname)
+            else:
+                try:
+                    database = client[dbname]
+                except KeyError:
+                    print(f'database {dbname} not found')
+                    sys.exit(1)
+
+            if split:
+                target, args = _range_worker, (path, index, bounds, id_field)
+            else:
+                target, args = _worker, (process_queue,)
+
+            args += (done_queue, database, options)
+
+            process = multiprocessing.Process(
+                target=instrument.run,
+                args=(instrument.context(), target, *args))
+
+            process.start()
+            process_pool.append(process)
+
+        done = False
+        try:
+            if not split:
+                entries = _entries(stream, input_format, single, id_field,
+                                   ranges[0])
+                for count, entry in enumerate(entries, 1):
+                    if not _put(process_queue, entry,
+                                lambda: any(x.exitcode for x in process_pool)):
+                        print('a worker failed, stopping input')
+                        break
+                    if count % CHECKPOINT_DRAIN:
+                        continue
+                    with contextlib.suppress(NotImplementedError):
+                        instrument.stage('parse').peak(
+                            queue=process_queue.qsize())
+                    if checkpoint is not None:
+                        _drain(done_queue, checkpoint)
+
+                for _ in range(pool_size):
+                    _put(process_queue, STOP,
+                         lambda: not any(x.is_alive() for x in process_pool))
+
+            while (checkpoint is not None
+                   and any(x.is_alive() for x in process_pool)):
+                _drain(done_queue, checkpoint, timeout=1)
+
+            for process in process_pool:
+                process.join()
 
-        process_queue.put(item)
+            if checkpoint is not None:
+                _drain(done_queue, checkpoint)
 
-    for _ in range(pool_size):
-        process_queue.put(STOP)
+            done = all(x.exitcode == 0 for x in process_pool)
+        finally:
+            _close(checkpoint, done)
 
-    for process in process_pool:
-        process.join()
+        if not done:
+            sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,345 @@
+'''
+Created on 18 oct 2026
+
+@author: Alessandro Ogier <alessandro.ogier@gmail.com>
+
+Instrumentation shared by the tools: per stage counters and peaks in
+every process, periodic progress lines on stderr, a final JSON report
+and merged cProfile stats.
+
+A tool runs within a Session and counts things on stages:
+
+    with instrument.Session('build', progress, report, profile):
+        with instrument.stage('read') as stage:
+            stage.add(batches=1, bytes_in=len(batch))
+            stage.peak(queue=queue.qsize())
+
+Worker processes run their target through instrument.run() with the
+session context(), which ships their stages back to the session.
+'''
+from collections import Counter, namedtuple
+import contextlib
+import cProfile
+import itertools
+import json
+import multiprocessing
+import os
+import pstats
+import queue
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import click
+
+
+COLLECT_INTERVAL = 0.5
+
+Context = namedtuple('Context', ('channel', 'interval', 'profile_dir'))
+
+_STAGES = {}
+_CONTEXT = []
+_DUMPS = itertools.count()
+
+
+class Stage:
+    '''
+    Counters and peak values of a processing stage, timed from its
+    creation until stop().
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.counters = Counter()
+        self.peaks = {}
+        self.started = time.monotonic()
+        self.stopped = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def add(self, **counts):
+        self.counters.update(counts)
+
+    def peak(self, **values):
+        for name, value in values.items():
+            if value > self.peaks.get(name, value - 1):
+                self.peaks[name] = value
+
+    def stop(self):
+        self.stopped = time.monotonic()
+
+    def snapshot(self):
+        return {'counters': dict(self.counters),
+                'peaks': dict(self.peaks),
+                'wall': (self.stopped or time.monotonic()) - self.started}
+
+
+def stage(name):
+    '''
+    This process' stage called name, created on first use.
+    '''
+
+    stages = _STAGES.setdefault(os.getpid(), {})
+    if name not in stages:
+        stages[name] = Stage(name)
+    return stages[name]
+
+
+def _rss():
+    # KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _snapshot():
+    return {'pid': os.getpid(),
+            'rss': _rss(),
+            'stages': {name: x.snapshot()
+                       for name, x
+                       in _STAGES.get(os.getpid(), {}).items()}}
+
+
+def context():
+    '''
+    The running session context, to hand over to worker processes; None
+    when there is no session or it records nothing.
+    '''
+
+    return _CONTEXT[-1] if _CONTEXT else None
+
+
+@contextlib.contextmanager
+def worker(ctx):
+    '''
+    Ship this process' stages to the session of ctx every ctx.interval
+    seconds and when done, profiling the body if the session does.
+    '''
+
+    if ctx is None:
+        yield
+        return
+
+    stop = threading.Event()
+
+    def ship():
+        while not stop.wait(ctx.interval or None):
+            ctx.channel.put(_snapshot())
+
+    thread = threading.Thread(target=ship, daemon=True)
+    thread.start()
+
+    profiler = cProfile.Profile() if ctx.profile_dir else None
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(
+                ctx.profile_dir, f'{os.getpid()}-{next(_DUMPS)}.prof'))
+        stop.set()
+        thread.join()
+        ctx.channel.put(_snapshot())
+
+
+def run(ctx, target, *args):
+    '''
+    multiprocessing target running target(*args) as a worker of ctx.
+    '''
+
+    with worker(ctx):
+        target(*args)
+
+
+def _human(value):
+    for unit in ('', 'k', 'M', 'G'):
+        if abs(value) < 1000:
+            break
+        value /= 1000
+    return f'{value:.4g}{unit}'
+
+
+def _merge(snapshots):
+    '''
+    Merge processes snapshots by stage: counters add up, peaks and wall
+    times are the max ones.
+    '''
+
+    stages = {}
+    for snapshot in snapshots:
+        for name, data in snapshot['stages'].items():
+            merged = stages.setdefault(name, {'counters': Counter(),
+                                              'peaks': {},
+                                              'wall': 0,
+                                              'processes': 0,
+                                              'peak_rss_kib': 0})
+            merged['counters'].update(data['counters'])
+            for peak, value in data['peaks'].items():
+                merged['peaks'][peak] = max(value,
+                                            merged['peaks'].get(peak, value))
+            merged['wall'] = max(merged['wall'], data['wall'])
+            merged['processes'] += 1
+            merged['peak_rss_kib'] = max(merged['peak_rss_kib'],
+                                         snapshot['rss'])
+
+    for merged in stages.values():
+        merged['counters'] = dict(merged['counters'])
+        merged['per_second'] = {name: value / merged['wall']
+                                for name, value in merged['counters'].items()
+                                if merged['wall']}
+
+    return stages
+
+
+class Session:
+    '''
+    Collect the stages of this process and of its workers, print a
+    progress line every progress seconds and, once done, write the JSON
+    report to report and merged cProfile stats to profile.
+
+    A session with none of those records nothing.
+    '''
+
+    def __init__(self, tool, progress=None, report=None, profile=None):
+        self.tool = tool
+        self.progress = progress
+        self.report = report
+        self.profile = profile
+        self.enabled = bool(progress or report or profile)
+        self.snapshots = {}
+        self.started = None
+        self.channel = None
+        self.profile_dir = None
+        self.profiler = None
+        self.stop = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        if not self.enabled:
+            return self
+
+        self.started = time.monotonic()
+        self.channel = multiprocessing.Queue()
+
+        if self.profile:
+            self.profile_dir = tempfile.mkdtemp(prefix='profile-')
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+        _CONTEXT.append(Context(self.channel, self.progress,
+                                self.profile_dir))
+
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+        return self
+
+    def __exit__(self, *exc_info):
+        if not self.enabled:
+            return
+
+        _CONTEXT.pop()
+        self.stop.set()
+        self.thread.join()
+
+        if self.profiler:
+            self.profiler.disable()
+            self.profiler.dump_stats(os.path.join(self.profile_dir,
+                                                  'main.prof'))
+
+        self._collect()
+        if self.progress:
+            self._print()
+
+        if self.report:
+            with click.open_file(self.report, 'w') as output:
+                json.dump(self.results(), output, indent=2)
+                output.write('\n')
+
+        if self.profile:
+            pstats.Stats(*(os.path.join(self.profile_dir, x)
+                           for x in os.listdir(self.profile_dir))) \
+                .dump_stats(self.profile)
+            shutil.rmtree(self.profile_dir)
+
+    def _loop(self):
+        last = time.monotonic()
+        while not self.stop.wait(COLLECT_INTERVAL):
+            self._collect()
+            if self.progress and time.monotonic() - last >= self.progress:
+                self._print()
+                last = time.monotonic()
+
+    def _collect(self):
+        try:
+            while True:
+                snapshot = self.channel.get_nowait()
+                self.snapshots[snapshot['pid']] = snapshot
+        except queue.Empty:
+            pass
+
+        self.snapshots[os.getpid()] = _snapshot()
+
+    def results(self):
+        '''
+        The report: per stage counters, rates, peaks, wall times and peak
+        RSS, all processes merged.
+        '''
+
+        return {
+            'tool': self.tool,
+            'wall': time.monotonic() - self.started,
+            'processes': len(self.snapshots),
+            'peak_rss_kib': max(x['rss'] for x in self.snapshots.values()),
+            'stages': _merge(self.snapshots.values()),
+        }
+
+    def _print(self):
+        parts = []
+        for name, data in _merge(self.snapshots.values()).items():
+            values = [f'{counter}={_human(value)}'
+                      for counter, value in data['counters'].items()]
+            values.extend(f'{peak}<={_human(value)}'
+                          for peak, value in data['peaks'].items())
+            rates = data['per_second']
+            if rates:
+                counter = max(rates, key=rates.get)
+                values.append(f'{_human(rates[counter])} {counter}/s')
+            parts.append(f'{name} {data["wall"]:.1f}s: {" ".join(values)}')
+
+        if not parts:
+            return
+
+        print(f'{self.tool} [{time.monotonic() - self.started:.1f}s] '
+              + ' | '.join(parts), file=sys.stderr, flush=True)
+
+
+def options(command):
+    '''
+    Add the --progress, --report and --profile options to a click
+    command.
+    '''
+
+    for option in reversed((
+            click.option('--progress',
+                         help='print progress lines on stderr every this '
+                         'many seconds',
+                         type=click.FLOAT, metavar='<seconds>'),
+            click.option('--report',
+                         help='write a JSON report of per stage counters '
+                         'and timings here when done, - for stdout',
+                         metavar='<path>'),
+            click.option('--profile',
+                         help='write cProfile stats of all processes, '
+                         'merged, here (debug only)',
+                         type=click.Path(dir_okay=False), metavar='<path>'))):
+        command = option(command)
+
+    return command